@@ -2,15 +2,31 @@
 import os
 import shutil
 import json
+import logging
 from StringIO import StringIO
 from csv import DictReader
 import webstore.web as ws
+from webstore.views import db_factory
+from webstore.database import ResultCache, TableHandler, \
+    DatabaseHandler
+from webstore.formats import render_table
+from webstore.formats.jsonstream import JSONStream
+from webstore.lru import LRUTimeoutCache, CacheKeyError
+from sqlalchemy.exc import DatabaseError, OperationalError
+from sqlalchemy.sql import select
+from sqlalchemy import event
 import unittest
+from contextlib import contextmanager
+import flask
 import tempfile
+import time
+import sqlite3
+import zlib
 
 JSON = 'application/json'
 JSONT = 'application/json+tuples'
 CSV = 'text/csv'
+NDJSON = 'application/x-ndjson'
 
 CSV_FIXTURE = """date,temperature,place
 2011-01-01,1,Galway
@@ -35,6 +51,22 @@ JSONTUPLES_FIXTURE = {"keys": ["foo", "bar"],
                       "data": [["fval1", "bval1"],
                                ["fval2", "bval2"]]}
 
+@contextmanager
+def configured(**settings):
+    """ Change settings of the app for the duration of a block, 
+    restoring their previous values afterwards. """
+    missing = object()
+    saved = dict((k, ws.app.config.get(k, missing)) for k in settings)
+    ws.app.config.update(settings)
+    try:
+        yield
+    finally:
+        for (key, value) in saved.items():
+            if value is missing:
+                ws.app.config.pop(key, None)
+            else:
+                ws.app.config[key] = value
+
 class WebstoreTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -91,7 +123,46 @@ class WebstoreTestCase(unittest.TestCase):
         assert 'Successfully' in body['message'], body
         assert 'success' == body['state'], body
         assert '/hugo/create_json_table/foo' == body['url'], body
-    
+
+    def test_create_json_table_streamed(self):
+        rows = [{'n': i, 'text': u'r\xf6w %s' % i} for i in xrange(5000)]
+        response = self.app.post('/hugo/fixtures?table=many',
+                headers={'Accept': JSON}, content_type=JSON,
+                data=json.dumps(rows, indent=1))
+        assert response.status.startswith("201"), response.data
+        response = self.app.get('/hugo/fixtures/many?_count=1&_limit=1'
+                '&_sort=desc:n', headers={'Accept': JSON})
+        body = json.loads(response.data)
+        assert body['count'] == 5000, body
+        assert body['data'][0]['text'] == u'r\xf6w 4999', body
+        data = '{"data": [["fval1", "bval1"]], "keys": ["foo", "bar"]}'
+        response = self.app.post('/hugo/fixtures?table=late_keys',
+                headers={'Accept': JSON}, content_type=JSONT, data=data)
+        assert response.status.startswith("201"), response.data
+        response = self.app.get('/hugo/fixtures/late_keys',
+                headers={'Accept': JSON})
+        assert json.loads(response.data)['data'][0]['bar'] == 'bval1'
+        # large values are not decoded from the start for every block.
+        data = json.dumps([['x' * 10, i] for i in range(2000)])
+        stream = JSONStream(data[i:i + 100] for i in range(0, len(data), 100))
+        calls = []
+        decode = stream.decoder.raw_decode
+        stream.decoder.raw_decode = lambda *a: calls.append(a) or decode(*a)
+        assert len(stream.value()) == 2000
+        assert len(calls) < 20, len(calls)
+
+    def test_create_and_read_ndjson_table(self):
+        data = '{"foo": "bar", "n": 1}\n\n{"foo": "baz", "n": 2}\n'
+        response = self.app.post('/hugo/fixtures?table=lines',
+                headers={'Accept': NDJSON}, content_type=NDJSON, data=data)
+        assert response.status.startswith("201"), response.data
+        assert json.loads(response.data)['state'] == 'success', response.data
+        response = self.app.get('/hugo/fixtures/lines.ndjson')
+        assert response.content_type == NDJSON, response.content_type
+        lines = response.data.splitlines()
+        assert len(lines) == 2, lines
+        assert json.loads(lines[1])['foo'] == 'baz', lines
+
     def test_create_json_tuples_table(self):
         response = self.app.post('/hugo/create_jsont_table?table=foo',
                 headers={'Accept': JSON}, content_type=JSONT,
@@ -144,6 +215,9 @@ class WebstoreTestCase(unittest.TestCase):
         response = self.app.get('/hugo/fixtures', 
                 headers={'Accept': 'application/x-sqlite3'})
         assert response.data.startswith("SQLite format 3"), response.data
+        response = self.app.get('/hugo/fixtures', headers={
+            'Accept': 'application/x-sqlite3', 'Accept-Encoding': 'gzip'})
+        assert not 'Content-Encoding' in response.headers, response.headers
 
     def test_upsert_table(self):
         response = self.app.post('/hugo/fixtures/json',
@@ -241,9 +315,46 @@ class WebstoreTestCase(unittest.TestCase):
         response = self.app.get('/hugo/fixtures/csv?_sort=desc:temperature',
             headers={'Accept': JSON})
         body = json.loads(response.data)
-        assert body['data'][0]['temperature'] == '8', body
+        assert body['data'][0]['temperature'] == 8, body
         assert body['data'][0]['place'] == 'Berkeley', body
-    
+
+    def test_read_json_representation_after_cursor(self):
+        for sort, first in (('', 1), ('&_sort=desc:temperature', 8)):
+            rows, cursor = [], ''
+            while cursor is not None:
+                response = self.app.get('/hugo/fixtures/csv?_limit=4&_after=%s%s'
+                    '&_count=1' % (cursor, sort), headers={'Accept': JSON})
+                assert response.status.startswith("200"), response.data
+                # the count covers all pages.
+                assert response.headers['X-Count'] == '6', response.headers
+                rows.extend(json.loads(response.data)['data'])
+                cursor = response.headers.get('X-Next-Cursor')
+            assert len(rows) == 6, rows
+            assert rows[0]['temperature'] == first, rows
+            assert len(set(r['__id__'] for r in rows)) == 6, rows
+        response = self.app.get('/hugo/fixtures/csv?_after=BANANA',
+            headers={'Accept': JSON})
+        assert response.status.startswith("400"), response.status
+        response = self.app.get('/hugo/fixtures/csv?_after=&_offset=2',
+            headers={'Accept': JSON})
+        assert response.status.startswith("400"), response.status
+
+    def test_read_json_representation_maintained_count(self):
+        def count(query):
+            response = self.app.get('/hugo/fixtures/csv?_count=1' + query,
+                headers={'Accept': JSON})
+            return json.loads(response.data)['count']
+        assert count('') == 6
+        assert count('&place=Galway') == 3
+        self.app.post('/hugo/fixtures/csv', headers={'Accept': JSON},
+            content_type=JSON, data=json.dumps({'place': 'Galway'}))
+        assert count('') == 7
+        assert count('&place=Galway') == 4
+        self.app.put('/hugo/fixtures', headers={'Accept': JSON},
+            content_type='text/sql', data='DELETE FROM "csv" WHERE __id__ < 3')
+        assert count('') == 5
+        assert count('&place=Galway') == 2
+
     # FIXME: Headers do not appear in testing harness
     #def test_read_json_representation_count(self):
     #    response = self.app.get('/hugo/fixtures/csv',
@@ -288,6 +399,92 @@ class WebstoreTestCase(unittest.TestCase):
         data = json.loads(response.data)
         assert 'float' in data['message'], data
 
+    def test_read_inferred_csv_schema(self):
+        response = self.app.get('/hugo/fixtures/csv/schema',
+            headers={'Accept': JSON})
+        body = json.loads(response.data)
+        types = dict([(c['name'], c['type']) for c in body['data']])
+        assert types['date'] == 'date', types
+        assert types['temperature'] == 'integer', types
+        assert types['place'] == 'text', types
+        response = self.app.get('/hugo/fixtures/csv?date=2011-01-02',
+            headers={'Accept': JSON})
+        body = json.loads(response.data)
+        assert len(body['data']) == 2, body
+        assert body['data'][0]['date'] == '2011-01-02', body
+        response = self.app.get('/hugo/fixtures/csv?date=banana',
+            headers={'Accept': JSON})
+        body = json.loads(response.data)
+        assert len(body['data']) == 0, body
+
+    def test_create_csv_table_as_text(self):
+        with configured(TYPE_INFERENCE_SAMPLE=0):
+            self.app.post('/hugo/fixtures?table=text',
+                content_type=CSV, data=CSV_FIXTURE)
+        response = self.app.get('/hugo/fixtures/text/schema',
+            headers={'Accept': JSON})
+        body = json.loads(response.data)
+        for col in body['data']:
+            if col['name'] != '__id__':
+                assert col['type'] == 'text', col
+
+    def test_date_column_with_text(self):
+        with configured(TYPE_INFERENCE_SAMPLE=2):
+            response = self.app.post('/hugo/fixtures?table=dates',
+                headers={'Accept': JSON}, content_type=CSV,
+                data='day,n\n2011-01-01,1\n2011-01-02,2\nsoon,3\n')
+        assert response.status.startswith("201"), response.data
+        response = self.app.get('/hugo/fixtures/dates.csv')
+        assert 'soon' in response.data, response.data
+        assert '2011-01-02' in response.data, response.data
+        response = self.app.put('/hugo/fixtures', content_type='text/sql',
+            headers={'Accept': JSON},
+            data="UPDATE csv SET date = '02/01/2011' WHERE __id__ = 1")
+        assert response.status.startswith("200"), response.data
+        response = self.app.get('/hugo/fixtures/csv.csv')
+        assert response.status.startswith("200"), response.status
+        assert '02/01/2011' in response.data, response.data
+        response = self.app.get('/hugo/fixtures/csv/distinct/date',
+            headers={'Accept': JSON})
+        body = json.loads(response.data)
+        values = [r['date'] for r in body['data']]
+        assert '02/01/2011' in values, values
+        assert '2011-01-02' in values, values
+
+    def test_append_text_to_numeric_columns(self):
+        response = self.app.post('/hugo/fixtures?table=prices',
+            headers={'Accept': JSON}, content_type=CSV,
+            data='price,n\n1.5,1\n')
+        assert response.status.startswith("201"), response.data
+        response = self.app.post('/hugo/fixtures/prices',
+            headers={'Accept': JSON}, content_type=CSV,
+            data='price,n\nN/A,007\n')
+        assert response.status.startswith("201"), response.data
+        response = self.app.get('/hugo/fixtures/prices?_sort=asc:__id__',
+            headers={'Accept': JSON})
+        body = json.loads(response.data)
+        assert body['data'][1]['price'] == 'N/A', body
+        # text which looks like a number is converted by SQLite.
+        assert body['data'][1]['n'] == 7, body
+
+    def test_create_csv_table_from_truncated_upload(self):
+        data = CSV_FIXTURE.replace('\n', '\r\n')
+        response = self.app.post('/hugo/fixtures?table=crlf',
+            headers={'Accept': JSON}, content_type=CSV, data=data)
+        assert response.status.startswith("201"), response.status
+        response = self.app.get('/hugo/fixtures/crlf',
+            headers={'Accept': JSON})
+        body = json.loads(response.data)
+        assert len(body['data']) == 6, body
+        assert body['data'][5]['place'] == 'Berkeley', body
+        response = self.app.post('/hugo/fixtures?table=truncated',
+            headers={'Accept': JSON}, content_type=CSV, data=data,
+            environ_overrides={'CONTENT_LENGTH': str(len(data) + 100)})
+        assert response.status.startswith("400"), response.status
+        response = self.app.get('/hugo/fixtures/truncated',
+            headers={'Accept': JSON})
+        assert not json.loads(response.data)['data'], response.data
+
     def test_put_additional_row(self):
         update = [{'place': 'Honolulu', 'climate': 'mild'}]
         response = self.app.put('/hugo/fixtures/csv',
@@ -328,6 +525,67 @@ class WebstoreTestCase(unittest.TestCase):
         body = json.loads(response.data)
         assert body['data'][0]['country'] == 'United States', body
 
+    def test_create_columns_from_lookahead_window(self):
+        data = [{'a': 'x'}] * 10 + [{'a': 'y', 'b': 'late'}]
+        response = self.app.post('/hugo/lookahead?table=foo',
+                headers={'Accept': JSON}, content_type=JSON,
+                data=json.dumps(data))
+        assert response.status.startswith("201"), response.status
+        with ws.app.test_request_context():
+            _table = db_factory.create('hugo', 'lookahead')['foo']
+            assert _table.columns == frozenset(['__id__', 'a', 'b'])
+            _table.add_rows([{'c': 1}] + [{'a': 'z'}] * 5, 
+                            batch_size=2, lookahead=2)
+            assert 'c' in _table.columns, _table.columns
+            _table.commit()
+
+    def test_put_rows_with_unique_index(self):
+        update = [{'row1': 'value2', 'foo': 'updated', 'odd :col': 'x'},
+                  {'row1': 'new', 'foo': 'added'}]
+        response = self.app.put('/hugo/fixtures/json?unique=row1',
+                headers={'Accept': JSON}, content_type=JSON,
+                data=json.dumps(update))
+        assert response.status.startswith("201"), response.status
+        response = self.app.get('/hugo/fixtures/json?_sort=asc:__id__',
+            headers={'Accept': JSON})
+        body = json.loads(response.data)
+        assert len(body['data']) == 3, body
+        assert body['data'][1]['foo'] == 'updated', body
+        assert body['data'][1]['odd :col'] == 'x', body
+        assert body['data'][2]['foo'] == 'added', body
+        response = self.app.put('/hugo/fixtures/json',
+                headers={'Accept': JSON}, content_type=JSON,
+                data=json.dumps(update))
+        assert response.status.startswith("400"), response.status
+
+    def test_put_rows_with_repeated_unique_columns(self):
+        update = [{'row1': 'value2', 'foo': 'again'}]
+        response = self.app.put('/hugo/fixtures/json?unique=row1&unique=row1',
+                headers={'Accept': JSON}, content_type=JSON,
+                data=json.dumps(update))
+        assert response.status.startswith("201"), response.data
+        response = self.app.get('/hugo/fixtures/json?row1=value2',
+            headers={'Accept': JSON})
+        body = json.loads(response.data)
+        assert body['data'][0]['foo'] == 'again', body
+
+    def test_put_rows_with_duplicate_unique_columns(self):
+        update = [{'place': 'Galway', 'country': 'Ireland'}]
+        for i in range(2):
+            response = self.app.put('/hugo/fixtures/csv?unique=place',
+                    headers={'Accept': JSON}, content_type=JSON,
+                    data=json.dumps(update))
+            assert response.status.startswith("201"), response.data
+        with ws.app.test_request_context():
+            db = db_factory.create('hugo', 'fixtures')
+            statements = []
+            event.listen(db.engine, 'before_cursor_execute',
+                lambda conn, cursor, stmt, *a: statements.append(stmt))
+            _table = db['csv']
+            assert not _table._unique_index(['place'])
+            _table.commit()
+        assert not any('UNIQUE' in s for s in statements), statements
+
     def test_put_sql_request(self):
         query = 'SELECT * FROM "csv"'
         response = self.app.put('/hugo/fixtures',
@@ -356,6 +614,21 @@ class WebstoreTestCase(unittest.TestCase):
         assert len(body['data']) == 3, body
         assert body['data'][0]['place']=='Galway', body
     
+    def test_sqlite_pragma_profiles(self):
+        query = 'PRAGMA journal_mode'
+        response = self.app.put('/hugo/fixtures',
+                headers={'Accept': JSON}, content_type='text/sql',
+                data=query)
+        body = json.loads(response.data)
+        assert body['data'][0]['journal_mode'] == 'wal', body
+        with configured(SQLITE_PRAGMA_PROFILES={
+                'hugo/plain': {'journal_mode': 'DELETE'}}):
+            response = self.app.put('/hugo/plain',
+                    headers={'Accept': JSON}, content_type='text/sql',
+                    data=query)
+        body = json.loads(response.data)
+        assert body['data'][0]['journal_mode'] == 'delete', body
+
     def test_put_sql_attach_database(self):
         query = {'query': 'SELECT * FROM foo."csv"',
                  'attach': [{'user': 'hugo', 
@@ -368,6 +641,267 @@ class WebstoreTestCase(unittest.TestCase):
         assert len(body['data']) == 6, body
         assert body['data'][0]['place']=='Galway', body
 
+    def test_pooled_connection_authorizers(self):
+        with ws.app.test_request_context():
+            db = db_factory.create('hugo', 'fixtures')
+            ro = db_factory.create_readonly('hugo', 'fixtures')
+            connection = ro.connect()
+            try:
+                connection.execute('DELETE FROM "csv"')
+                assert False, 'read-only connection could write'
+            except DatabaseError:
+                pass
+            connection.close()
+            connection = db.connect()
+            connection.execute('UPDATE "csv" SET place = ? WHERE 1 = 0', 'x')
+            db_factory.attach(db.authorizer, connection, 'hugo', 
+                              'fixtures', 'other')
+            connection.close()
+            connection = db.connect()
+            names = [r[1] for r in connection.execute('PRAGMA database_list')]
+            assert names == ['main'], names
+            connection.close()
+            status = db_factory.pool_status()[db.path]
+            assert status['size'] == 5, status
+
+    def test_read_gviz_representation(self):
+        response = self.app.get('/hugo/fixtures/csv.gviz')
+        body = json.loads(response.data)
+        types = dict([(c['id'], c['type']) for c in body['cols']])
+        assert types == {'__id__': 'number', 'date': 'date', 
+                         'temperature': 'number', 'place': 'string'}, types
+        assert len(body['rows']) == 6, body
+        dates = [r['c'][1]['v'] for r in body['rows']]
+        assert dates[0] == 'Date(2011,0,1)', dates
+        response = self.app.put('/hugo/fixtures.gviz', content_type='text/sql',
+                data='SELECT count(*) AS n FROM "csv"')
+        body = json.loads(response.data)
+        assert body['cols'][0]['type'] == 'number', body
+        assert body['rows'] == [{'c': [{'v': 6}]}], body
+        # text in a date column is only shown as a formatted value.
+        self.app.put('/hugo/fixtures', content_type='text/sql',
+            headers={'Accept': JSON},
+            data="UPDATE csv SET date = 'soon' WHERE __id__ = 6")
+        body = json.loads(self.app.get('/hugo/fixtures/csv.gviz').data)
+        assert body['rows'][5]['c'][1] == {'v': None, 'f': 'soon'}, body
+
+    def test_read_arrow_and_parquet_representation(self):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            response = self.app.get('/hugo/fixtures/csv.arrow')
+            assert response.status.startswith("501"), response.status
+            return
+        response = self.app.get('/hugo/fixtures/csv.arrow')
+        table = pyarrow.ipc.open_stream(response.data).read_all()
+        assert table.num_rows == 6, table
+        assert str(table.column('temperature').type) == 'int64', table
+        assert table.column('place').to_pylist()[0] == 'Galway'
+        response = self.app.get('/hugo/fixtures/csv.parquet')
+        table = pyarrow.parquet.read_table(pyarrow.BufferReader(response.data))
+        assert table.num_rows == 6, table
+        assert str(table.column('date').type) == 'date32[day]', table
+        # columns holding values which do not fit their type are sent
+        # as text, rather than losing those values.
+        self.app.put('/hugo/fixtures', content_type='text/sql',
+            headers={'Accept': JSON},
+            data="UPDATE csv SET date = 'soon' WHERE __id__ = 6")
+        for format in ('arrow', 'parquet'):
+            response = self.app.get('/hugo/fixtures/csv.' + format)
+            reader = pyarrow.BufferReader(response.data)
+            table = pyarrow.ipc.open_stream(reader).read_all() \
+                    if format == 'arrow' else pyarrow.parquet.read_table(reader)
+            dates = table.column('date').to_pylist()
+            assert dates[0] == '2011-01-01' and dates[5] == 'soon', dates
+            assert str(table.column('temperature').type) == 'int64', table
+
+    def test_read_html_and_csv_index(self):
+        response = self.app.get('/hugo/fixtures/csv?_limit=1',
+            headers={'Accept': 'text/html'})
+        assert '<td>Galway</td>' in response.data, response.data
+        response = self.app.get('/hugo/fixtures', headers={'Accept': CSV})
+        rows = list(DictReader(StringIO(response.data)))
+        assert sorted(r['name'] for r in rows) == ['csv', 'json'], rows
+
+    def test_table_output_in_chunks(self):
+        rows = [(i, 'row %s' % i) for i in xrange(2000)]
+        with configured(OUTPUT_CHUNK_SIZE=8192):
+            with ws.app.test_request_context():
+                flask.g.callback = None
+                for format in ('json', 'jsontuples', 'csv', 'ndjson'):
+                    response = render_table(flask.request, iter(rows), 
+                                            ['n', 'text'], format)
+                    chunks = list(response.response)
+                    assert len(chunks[0]) < 2048, (format, chunks[0])
+                    assert 2 < len(chunks) < 10, (format, map(len, chunks))
+                    assert '1999' in ''.join(chunks), format
+
+    def test_compressed_table_output(self):
+        rows = [{'n': i, 'text': 'row %s' % i} for i in xrange(2000)]
+        self.app.post('/hugo/compressed?table=foo', content_type=JSON,
+                      data=json.dumps(rows))
+        plain = self.app.get('/hugo/compressed/foo.csv').data
+        response = self.app.get('/hugo/compressed/foo.csv',
+                                headers={'Accept-Encoding': 'gzip'})
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert 'Accept-Encoding' in response.headers['Vary']
+        assert len(response.data) < len(plain) / 2, len(response.data)
+        assert zlib.decompress(response.data, 16 + zlib.MAX_WBITS) == plain
+        response = self.app.get('/hugo/compressed/foo.csv',
+                                headers={'Accept-Encoding': 'gzip;q=0'})
+        assert response.data == plain, response.headers
+        response = self.app.get('/hugo/compressed/foo.csv?_limit=2',
+                                headers={'Accept-Encoding': 'gzip'})
+        assert not 'Content-Encoding' in response.headers, response.headers
+        assert response.data.startswith('__id__,'), response.data
+
+    def test_conditional_get(self):
+        # the first count and distinct queries set up their tables,
+        # which must not make the ETag they are sent with stale.
+        for url in ('/hugo/fixtures/csv', '/hugo/fixtures/csv/schema',
+                    '/hugo/fixtures/csv?_count=1',
+                    '/hugo/fixtures/csv/row/2',
+                    '/hugo/fixtures/csv/distinct/place', '/hugo/fixtures',
+                    '/hugo/fixtures.db'):
+            response = self.app.get(url)
+            assert response.status_code == 200, (url, response.status)
+            etag = response.headers['ETag']
+            assert response.headers['Last-Modified'], response.headers
+            response = self.app.get(url, headers={'If-None-Match': etag})
+            assert response.status_code == 304, (url, response.status)
+            assert response.headers['ETag'] == etag, response.headers
+            assert not len(response.data), response.data
+        response = self.app.get('/hugo/fixtures/csv?place=Galway', 
+                                headers={'If-None-Match': etag})
+        assert response.status_code == 200, response.status
+        etag = response.headers['ETag']
+        since = response.headers['Last-Modified']
+        # the ETag is derived from the database files, so it stays the
+        # same for other processes and after handlers are closed.
+        with ws.app.test_request_context():
+            db_factory.cache.invalidate(lambda key: True)
+        response = self.app.get('/hugo/fixtures/csv?place=Galway', 
+                                headers={'If-None-Match': etag})
+        assert response.status_code == 304, response.status
+        self.app.put('/hugo/fixtures/csv', content_type=JSON,
+                     data=json.dumps([{'place': 'Cork'}]))
+        response = self.app.get('/hugo/fixtures/csv?place=Galway', 
+                                headers={'If-None-Match': etag})
+        assert response.status_code == 200, response.status
+        assert response.headers['ETag'] != etag, response.headers
+        # a change within the second of the last one has the same date.
+        response = self.app.get('/hugo/fixtures/csv?place=Galway', 
+                                headers={'If-Modified-Since': since})
+        assert response.status_code == 200, response.status
+
+    def test_result_cache(self):
+        with configured(RESULT_CACHE_SIZE=64 * 1024, 
+                        RESULT_CACHE_ENTRY_LIMIT=256, RESULT_CACHE_SQL=False):
+            url = '/hugo/fixtures/csv.csv?place=Galway'
+            first = self.app.get(url)
+            assert first.headers['X-Cache'] == 'MISS', first.headers
+            # results are stored once they have been sent.
+            data = first.data
+            with ws.app.test_request_context():
+                hits = db_factory.results.stats()['hits']
+            response = self.app.get(url)
+            assert response.headers['X-Cache'] == 'HIT', response.headers
+            assert response.data == data, response.data
+            with ws.app.test_request_context():
+                assert db_factory.results.stats()['hits'] == hits + 1
+            # the version taken for the ETag is reused for the cache.
+            calls = []
+            version = DatabaseHandler.version
+            DatabaseHandler.version = lambda db: calls.append(db) or version(db)
+            try:
+                self.app.get(url).data
+            finally:
+                DatabaseHandler.version = version
+            assert len(calls) == 1, calls
+            query = "SELECT place FROM csv WHERE place = 'Galway'"
+            response = self.app.put('/hugo/fixtures.csv', 
+                content_type='text/sql', data=query)
+            assert not 'X-Cache' in response.headers, response.headers
+            assert response.data.count('Galway') == 3, response.data
+            ws.app.config['RESULT_CACHE_SQL'] = True
+            for status in ('MISS', 'HIT'):
+                response = self.app.put('/hugo/fixtures.csv', 
+                    content_type='text/sql', data=query)
+                assert response.headers['X-Cache'] == status, status
+                assert response.data.count('Galway') == 3, response.data
+            for volatile in ("SELECT random() AS r", 
+                             "SELECT strftime('%s', 'now') AS t"):
+                response = self.app.put('/hugo/fixtures.csv', 
+                    content_type='text/sql', data=volatile)
+                assert response.status_code == 200, response.data
+                assert not 'X-Cache' in response.headers, volatile
+            self.app.put('/hugo/fixtures/csv', content_type=JSON,
+                         data=json.dumps([{'place': 'Galway'}]))
+            response = self.app.get(url)
+            assert response.headers['X-Cache'] == 'MISS', response.headers
+            assert response.data.count('Galway') == 4, response.data
+            # results beyond the entry limit are not kept.
+            assert len(self.app.get('/hugo/fixtures/csv.json').data) > 256
+            response = self.app.get('/hugo/fixtures/csv.json')
+            assert response.headers['X-Cache'] == 'MISS', response.headers
+
+    def test_result_cache_logs_stats(self):
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        logger = logging.getLogger('webstore.database')
+        logger.addHandler(handler)
+        level = logger.level
+        logger.setLevel(logging.INFO)
+        try:
+            cache = ResultCache(100, 10, log_interval=0.01)
+            time.sleep(0.02)
+            cache.put('a', 1, 'x', 1)
+            assert cache.get('a', 1) == 'x'
+        finally:
+            logger.removeHandler(handler)
+            logger.setLevel(level)
+        assert len(records) == 1, records
+        assert "'misses': 0" in records[0].getMessage(), records
+
+    def test_lru_timeout_cache(self):
+        cache = LRUTimeoutCache(2, timeout=60, negative_timeout=-1)
+        cache['a'] = 1
+        cache['b'] = 2
+        assert cache['a'] == 1
+        cache['c'] = 3
+        assert list(cache) == ['a', 'c'], list(cache)
+        assert cache.get('b') is None
+        cache['d'] = False
+        assert not 'd' in cache and cache.get('d', 'x') == 'x'
+        cache.set('e', 5, timeout=-1)
+        assert not 'e' in cache
+        del cache['c']
+        self.assertRaises(CacheKeyError, cache.__delitem__, 'c')
+        self.assertRaises(CacheKeyError, cache.__getitem__, 'c')
+        stats = cache.stats()
+        assert (stats['hits'], stats['misses']) == (1, 3), stats
+        assert stats['evictions'] == 2, stats
+
+    def test_connections_released_after_response(self):
+        response = self.app.post('/hugo/lifecycle?table=foo',
+                headers={'Accept': JSON}, content_type=JSON,
+                data=json.dumps(JSON_FIXTURE))
+        response.close()
+        response = self.app.get('/hugo/lifecycle/foo?_count=1',
+            headers={'Accept': JSON})
+        assert len(json.loads(response.data)['data']) == 2
+        response.close()
+        with ws.app.test_request_context():
+            db = db_factory.create('hugo', 'lifecycle')
+            assert db.pool_status()['checkedout'] == 0, db.pool_status()
+            _table = db['foo']
+            assert _table.bind.execute(_table.table.select()).fetchall()
+            assert _table.tx is None
+            _table.close()
+            assert db.pool_status()['checkedout'] == 0, db.pool_status()
+
     def test_read_json_single_row(self):
         response = self.app.get('/hugo/fixtures/json/row/0',
             headers={'Accept': JSON})
@@ -378,7 +912,105 @@ class WebstoreTestCase(unittest.TestCase):
         body = json.loads(response.data)
         assert response.status.startswith("200"), response.status
         assert body['data'][0]['place'] == 'Galway', body
-        assert body['data'][0]['temperature'] == '0', body
+        assert body['data'][0]['temperature'] == 0, body
+
+    def test_read_json_single_row_with_gaps(self):
+        response = self.app.get('/hugo/fixtures/csv/row/4',
+            headers={'Accept': JSON})
+        assert json.loads(response.data)['data'][0]['__id__'] == 4
+        self.app.put('/hugo/fixtures', headers={'Accept': JSON},
+            content_type='text/sql', data='DELETE FROM "csv" WHERE __id__ = 2')
+        response = self.app.get('/hugo/fixtures/csv/row/4',
+            headers={'Accept': JSON})
+        body = json.loads(response.data)
+        assert body['data'][0]['__id__'] == 5, body
+        self.app.post('/hugo/fixtures/csv', headers={'Accept': JSON},
+            content_type=JSON, data=json.dumps({'place': 'Cork'}))
+        response = self.app.get('/hugo/fixtures/csv/row/6',
+            headers={'Accept': JSON})
+        body = json.loads(response.data)
+        assert body['data'][0]['place'] == 'Cork', body
+        response = self.app.get('/hugo/fixtures', headers={'Accept': JSON})
+        names = [t['name'] for t in json.loads(response.data)['data']]
+        assert not [n for n in names if n.startswith('_')], names
+
+    def test_reads_do_not_write(self):
+        self.app.put('/hugo/raw', headers={'Accept': JSON},
+            content_type='text/sql', data='CREATE TABLE foo '
+                '(__id__ INTEGER PRIMARY KEY, n INTEGER)')
+        self.app.put('/hugo/raw', headers={'Accept': JSON},
+            content_type='text/sql', data='INSERT INTO foo (n) VALUES (5)')
+        with ws.app.test_request_context():
+            path = db_factory.create('hugo', 'raw').path
+        other = sqlite3.connect(path)
+        version = other.execute('PRAGMA schema_version').fetchone()
+        # neither the row counts nor the ordinal index are set up here.
+        other.execute('BEGIN IMMEDIATE')
+        try:
+            response = self.app.get('/hugo/raw/foo?_count=1',
+                headers={'Accept': JSON})
+            assert response.headers['X-Count'] == '1', response.headers
+            response = self.app.get('/hugo/raw/foo/row/1',
+                headers={'Accept': JSON})
+            assert json.loads(response.data)['data'][0]['n'] == 5
+        finally:
+            other.rollback()
+        assert other.execute('PRAGMA schema_version').fetchone() == version
+        # but before the next write.
+        self.app.post('/hugo/raw/foo', headers={'Accept': JSON},
+            content_type=JSON, data=json.dumps({'n': 6}))
+        names = [n for (n,) in other.execute("SELECT name FROM "
+                 "sqlite_master WHERE name LIKE '_webstore_%'")]
+        assert '_webstore_ordinal_foo' in names, names
+        other.close()
+        response = self.app.get('/hugo/raw/foo/row/2?_count=1',
+            headers={'Accept': JSON})
+        assert json.loads(response.data)['data'][0]['n'] == 6
+
+    def test_locked_database_is_busy(self):
+        def locked(self, column):
+            raise OperationalError('BEGIN IMMEDIATE', {},
+                    sqlite3.OperationalError('database is locked'))
+        frequencies = TableHandler.frequencies
+        TableHandler.frequencies = locked
+        try:
+            response = self.app.get('/hugo/fixtures/csv/distinct/place',
+                headers={'Accept': JSON})
+        finally:
+            TableHandler.frequencies = frequencies
+        assert response.status.startswith("503"), response.status
+        assert response.headers['Retry-After'] == '1', response.headers
+
+    def test_insert_with_ordinal_index(self):
+        self.app.post('/hugo/ordinal?table=foo', content_type=JSON,
+                      data=json.dumps([{'n': i} for i in xrange(10000)]))
+        self.app.get('/hugo/ordinal/foo/row/5', headers={'Accept': JSON})
+        self.app.put('/hugo/ordinal/foo', content_type=JSON,
+                     data=json.dumps([{'n': i} for i in xrange(5000)]))
+        with ws.app.test_request_context():
+            path = db_factory.create('hugo', 'ordinal').path
+        other = sqlite3.connect(path)
+        triggers = [n for (n,) in other.execute("SELECT name FROM "
+            "sqlite_master WHERE type = 'trigger' AND tbl_name = 'foo' "
+            "AND name LIKE '_webstore_ordinal_%'")]
+        assert '_webstore_ordinal_foo_insert' in triggers, triggers
+        # the index triggers must not scan the index for each row, so an
+        # insert takes far fewer steps than there are rows.
+        steps = []
+        other.set_progress_handler(lambda: steps.append(1), 1)
+        other.execute('INSERT INTO foo (n) VALUES (5000)')
+        other.set_progress_handler(None, 1)
+        other.commit()
+        other.close()
+        assert 0 < len(steps) < 1000, len(steps)
+        response = self.app.get('/hugo/ordinal/foo/row/15000',
+            headers={'Accept': JSON})
+        assert json.loads(response.data)['data'][0]['n'] == 4999
+        self.app.put('/hugo/ordinal', headers={'Accept': JSON},
+            content_type='text/sql', data='INSERT INTO foo (__id__, n) VALUES (0, -1)')
+        response = self.app.get('/hugo/ordinal/foo/row/1',
+            headers={'Accept': JSON})
+        assert json.loads(response.data)['data'][0]['n'] == -1
 
     def test_read_json_distinct_column(self):
         response = self.app.get('/hugo/fixtures/json/distinct/not_a_column',
@@ -390,6 +1022,103 @@ class WebstoreTestCase(unittest.TestCase):
         assert response.status.startswith("200"), response.status
         assert len(body['data'])==2, body
 
+    def test_distinct_setup_is_atomic(self):
+        with ws.app.test_request_context():
+            db = db_factory.create('hugo', 'fixtures')
+            _table = db['csv']
+            create_triggers = _table._create_triggers
+            def interrupted(*args):
+                create_triggers(*args)
+                # other writers have to wait until the table is filled.
+                other = sqlite3.connect(db.path, timeout=0)
+                self.assertRaises(sqlite3.OperationalError, other.execute,
+                                  "INSERT INTO csv (place) VALUES ('Cork')")
+                other.close()
+                raise ValueError('interrupted')
+            _table._create_triggers = interrupted
+            self.assertRaises(ValueError, _table.frequencies, 'place')
+            del _table._create_triggers
+            assert not _table.bind.execute("SELECT name FROM sqlite_master "
+                "WHERE name LIKE '_webstore_distinct_%'").fetchall()
+            frequencies = _table.frequencies('place')
+            counts = _table.bind.execute(select([frequencies.c.value,
+                frequencies.c._count])).fetchall()
+            assert sorted(map(tuple, counts)) == [('Berkeley', 3), \
+                                           ('Galway', 3)], counts
+            _table.close()
+
+    def test_read_json_distinct_column_after_writes(self):
+        def distinct(query=''):
+            response = self.app.get('/hugo/fixtures/csv/distinct/place' + query,
+                headers={'Accept': JSON})
+            return [(r['place'], r['_count']) for r in
+                    json.loads(response.data)['data']]
+        assert distinct() == [('Galway', 3), ('Berkeley', 3)] or \
+               distinct() == [('Berkeley', 3), ('Galway', 3)], distinct()
+        self.app.post('/hugo/fixtures/csv', headers={'Accept': JSON},
+            content_type=JSON, data=json.dumps([{'place': 'Galway'},
+                                                {'place': 'Cork'},
+                                                {'place': None}]))
+        assert distinct('?_limit=2') == [('Galway', 4), ('Berkeley', 3)], \
+                distinct()
+        self.app.put('/hugo/fixtures', headers={'Accept': JSON},
+            content_type='text/sql',
+            data='''UPDATE "csv" SET place = 'Cork' WHERE place = 'Berkeley' ''')
+        assert distinct('?_sort=asc:place') == \
+                [(None, 0), ('Cork', 4), ('Galway', 4)], distinct()
+        response = self.app.delete('/hugo/fixtures/csv')
+        assert response.status.startswith("410"), response.status
+        response = self.app.put('/hugo/fixtures', headers={'Accept': JSON},
+            content_type='text/sql', data='SELECT name FROM sqlite_master '
+                '''WHERE type = 'table' AND name LIKE '%csv%' ''')
+        assert not json.loads(response.data)['data'], response.data
+
+    def test_database_handler_cache(self):
+        with ws.app.test_request_context():
+            db = db_factory.create('hugo', 'fixtures')
+            assert db is db_factory.create('hugo', 'fixtures')
+            ro = db_factory.create_readonly('hugo', 'fixtures')
+            assert db is not ro
+            assert db.engine is ro.engine
+            db_factory.invalidate('hugo', 'fixtures')
+            assert db is not db_factory.create('hugo', 'fixtures')
+
+    def test_database_handler_cache_replaced_file(self):
+        with ws.app.test_request_context():
+            db = db_factory.create('hugo', 'fixtures')
+            os.unlink(db.path)
+            assert db is not db_factory.create('hugo', 'fixtures')
+        response = self.app.get('/hugo/fixtures', headers={'Accept': JSON})
+        body = json.loads(response.data)
+        assert len(body['data']) == 0, body
+
+    def test_reflected_table_cache(self):
+        with ws.app.test_request_context():
+            db = db_factory.create('hugo', 'fixtures')
+            assert db['csv'].table is db['csv'].table
+        response = self.app.put('/hugo/fixtures',
+                headers={'Accept': JSON}, content_type='text/sql',
+                data='ALTER TABLE "csv" ADD COLUMN "extra" TEXT')
+        response = self.app.get('/hugo/fixtures/csv/schema',
+            headers={'Accept': JSON})
+        body = json.loads(response.data)
+        assert len(body['data']) == 5, body
+
+    def test_create_table_in_batches(self):
+        data = [{'num': str(i)} if i % 3 else {'num': str(i), 'fizz': 'yes'}
+                for i in range(50)]
+        with configured(INGEST_BATCH_SIZE=7):
+            response = self.app.post('/hugo/batches?table=foo',
+                    headers={'Accept': JSON}, content_type=JSON,
+                    data=json.dumps(data))
+        body = json.loads(response.data)
+        assert '50 rows' in body['message'], body
+        response = self.app.get('/hugo/batches/foo?_count=1&fizz=yes',
+            headers={'Accept': JSON})
+        body = json.loads(response.data)
+        assert body['count'] == 17, body
+        assert body['data'][1]['num'] == '3', body
+
 
 CKAN_DB_FIXTURE = os.path.join(os.path.dirname(__file__), 'ckan.db')
 APIKEY = 'test-api-key'
@@ -1,18 +1,144 @@
 import os 
-from glob import iglob
+import re
+import sqlite3
+import time
 import logging
+import threading
+from copy import copy
+from contextlib import contextmanager
+from hashlib import sha1
+from datetime import date, datetime
+from glob import iglob
+from collections import OrderedDict
+from itertools import islice, groupby
 
-from sqlalchemy import create_engine
-from sqlalchemy import Integer, UnicodeText, Float
-from sqlalchemy.sql import and_
+from sqlalchemy import create_engine, event, func
+from sqlalchemy import Integer, UnicodeText, Float, Date
+from sqlalchemy.sql import and_, or_, text, bindparam, literal_column
+from sqlalchemy.sql import select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.dialects.sqlite import DATE as SQLITE_DATE
 from sqlalchemy.schema import Table, MetaData, Column
 from migrate.versioning.util import construct_engine
 
+from webstore.lru import LRUTimeoutCache
 from webstore.validation import (validate_name, validate_dbname, 
                                  validate_username, validate_columnname)
 
 log = logging.getLogger(__name__)
 ID_COLUMN = '__id__'
+# tables maintained by webstore itself; user table names cannot start 
+# with an underscore.
+INTERNAL_PREFIX = '_webstore_'
+ROW_COUNTS = INTERNAL_PREFIX + 'counts'
+
+# INSERT ... ON CONFLICT DO UPDATE was added in SQLite 3.24.0
+NATIVE_UPSERT = sqlite3.sqlite_version_info >= (3, 24, 0)
+
+# anything in an identifier which text() would mistake for a bind 
+# parameter needs to be escaped.
+BIND_PARAMS = re.compile(r'(?<![:\w\$\x5c]):([\w\$]+)(?![:\w\$])', re.UNICODE)
+
+# textual values which can safely be stored as numbers or dates. Numbers
+# with leading zeros are left alone as they tend to be codes, not amounts.
+INTEGER = re.compile(r'^-?(0|[1-9][0-9]*)$')
+FLOAT = re.compile(r'^-?(0|[1-9][0-9]*)(\.[0-9]+)?([eE][-+]?[0-9]+)?$')
+DATE = re.compile(r'^([0-9]{4})-([0-9]{2})-([0-9]{2})$')
+
+def _parse_date(value):
+    match = DATE.match(value)
+    if match is None:
+        raise ValueError('could not convert string to date: %s' % value)
+    return date(*map(int, match.groups()))
+
+def _pass_text(process):
+    # wrap a bind processor so that text is handed to the database as it
+    # is, which stores it unchanged unless it looks like a number.
+    def bind(value):
+        if isinstance(value, basestring):
+            return value
+        return process(value) if process else value
+    return bind
+
+class TextFloat(Float):
+    """ A FLOAT column which, like ``TextDate``, stores text which is 
+    not a number instead of refusing it. """
+
+    def bind_processor(self, dialect):
+        return _pass_text(super(TextFloat, self).bind_processor(dialect))
+
+class TextDate(SQLITE_DATE):
+    """ A DATE column which tolerates other values. SQLite does not 
+    enforce column types, so text which is not an ISO date (e.g. from a 
+    later upload or a SQL statement) is stored and read back as it is. """
+
+    def adapt(self, cls, **kw):
+        # the driver's own date type would bring back the strict
+        # processors.
+        return TextDate()
+
+    def bind_processor(self, dialect):
+        return _pass_text(super(TextDate, self).bind_processor(dialect))
+
+    def result_processor(self, dialect, coltype):
+        def result(value):
+            if isinstance(value, basestring):
+                try:
+                    return _parse_date(value)
+                except ValueError:
+                    pass
+            return value
+        return result
+
+def guess_text_type(values):
+    """ Guess the most specific column type which can hold all of the
+    given (non-empty) strings. """
+    candidates = [(Integer, lambda v: INTEGER.match(v) and \
+                    -2**63 <= int(v) < 2**63),
+                  (TextFloat, FLOAT.match),
+                  (TextDate, _parse_date)]
+    for value in values:
+        value = value.strip()
+        for candidate in list(candidates):
+            try:
+                if not candidate[1](value):
+                    candidates.remove(candidate)
+            except ValueError:
+                candidates.remove(candidate)
+        if not len(candidates):
+            break
+    if not len(values) or not len(candidates):
+        return UnicodeText
+    return candidates[0][0]
+
+def _text_converter(parse):
+    """ Build a function which converts textual values to the native 
+    type of a column. Empty strings become NULL, anything which cannot 
+    be parsed is passed on and left to the database, or refused with a 
+    ValueError if ``strict`` is set. """
+    def convert(value, strict=False):
+        if not isinstance(value, basestring):
+            return value if isinstance(value, (date, datetime)) \
+                    else unicode(value)
+        if not len(value.strip()):
+            return None
+        try:
+            return parse(value.strip())
+        except ValueError:
+            if strict:
+                raise
+            return unicode(value)
+    return convert
+
+def _integer(value):
+    if INTEGER.match(value) is None:
+        raise ValueError('could not convert string to integer: %s' % value)
+    return int(value)
+
+CONVERTERS = [(Integer, _text_converter(_integer)),
+              (Float, _text_converter(float)),
+              (Date, _text_converter(_parse_date))]
 
 class UserNotFound(Exception):
     pass
@@ -20,97 +146,711 @@ class UserNotFound(Exception):
 class DatabaseHandler(object):
     """ Handle database-wide operations. """
 
-    def __init__(self, engine):
+    def __init__(self, engine, authorizer=None, monitor=None):
         self.engine = construct_engine(engine)
         self.meta = MetaData()
         self.meta.bind = self.engine
+        self.authorizer = authorizer
+        self.lock = threading.RLock()
+        self.tables = {}
+        self.schema = {'version': None}
+        self.changes = {'connection': None}
+        self.monitor = monitor
+        self.counts = LRUTimeoutCache(1000, 60)
+        self.ordinals = set()
+        self._modes = {}
+
+    def using(self, authorizer):
+        """ Return a handler for the same database, sharing its pool
+        and reflected tables, which restricts the connections it hands 
+        out with the given authorizer. """
+        if authorizer is self.authorizer:
+            return self
+        with self.lock:
+            if not authorizer in self._modes:
+                handler = copy(self)
+                handler.authorizer = authorizer
+                self._modes[authorizer] = handler
+            return self._modes[authorizer]
+
+    def connect(self):
+        """ Check out a connection from the pool and set this handler's
+        authorizer on it. """
+        connection = self.engine.connect()
+        connection.connection.set_authorizer(
+                self.authorizer or authorizer_all)
+        return connection
+
+    def _forget_table(self, table_name):
+        # handlers are shared between requests, so drop any stale 
+        # definition before the table is defined again.
+        if table_name in self.meta.tables:
+            self.meta.remove(self.meta.tables[table_name])
 
     def _create_table(self, table_name):
         table_name = validate_name(table_name)
         log.debug("Creating table: %s on %r" % (table_name, self.engine))
+        self._forget_table(table_name)
         table = Table(table_name, self.meta)
         col = Column(ID_COLUMN, Integer, primary_key=True)
         table.append_column(col)
-        table.create(self.engine)
+        connection = self.connect()
+        try:
+            table.create(connection)
+        finally:
+            connection.close()
+        self.invalidate(table_name)
         return table
 
     def _load_table(self, table_name):
-        return Table(table_name, self.meta, autoload=True)
+        self._forget_table(table_name)
+        table = Table(table_name, self.meta, autoload=True)
+        # FLOAT and DATE columns may hold text as well, see TextDate.
+        for column in table.columns:
+            if isinstance(column.type, Float):
+                column.type = TextFloat()
+            elif isinstance(column.type, Date):
+                column.type = TextDate()
+        return table
+
+    def _check_schema(self):
+        """ Flush all reflected tables if the schema of the database 
+        has been changed since they were loaded, e.g. by another 
+        process or through a raw SQL query. """
+        version = self.engine.execute('PRAGMA schema_version').scalar()
+        if version != self.schema['version']:
+            log.debug("Schema changed: %s" % self.engine)
+            self.tables.clear()
+            self.schema['version'] = version
+
+    def invalidate(self, table_name):
+        """ Drop the reflected definition of a table after its 
+        schema has been modified. """
+        with self.lock:
+            self.tables.pop(table_name, None)
 
     def __contains__(self, table_name):
         """ Check if the given table exists. """
+        with self.lock:
+            self._check_schema()
+            if table_name in self.tables:
+                return True
         return self.engine.has_table(table_name)
 
     def __getitem__(self, table_name):
         """ return a TableHandler for the named table.
         If the table does not exist, create it. """
-        if not table_name in self:
-            table = self._create_table(table_name)
-        else:
-            table = self._load_table(table_name)
-        return TableHandler(table, self.engine, self.meta)
+        with self.lock:
+            self._check_schema()
+            table = self.tables.get(table_name)
+            if table is None:
+                if not self.engine.has_table(table_name):
+                    table = self._create_table(table_name)
+                else:
+                    table = self._load_table(table_name)
+                    self.tables[table_name] = table
+        return TableHandler(table, self.engine, self.meta, database=self)
+
+    def table_names(self):
+        """ List all tables in the database, except those maintained
+        by webstore itself. """
+        return [t for t in self.engine.table_names() \
+                if not t.startswith(INTERNAL_PREFIX)]
+
+    def checkpoint(self):
+        """ Copy all changes from the write-ahead log (if any) back 
+        into the database file itself. """
+        connection = self.connect()
+        try:
+            # resetting the log counts as a change to the database (see 
+            # ``version``), so only do so if the log could not be copied.
+            busy, log, copied = connection.execute(
+                'PRAGMA wal_checkpoint(PASSIVE)').fetchone()
+            if busy or copied < log:
+                connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        finally:
+            connection.close()
+
+    def _modified(self):
+        # in WAL mode, commits only touch the log until a checkpoint.
+        path = getattr(self, 'path', None)
+        times = [os.path.getmtime(p) for p in (path, path + '-wal') \
+                 if path is not None and os.path.isfile(p)]
+        return datetime.utcfromtimestamp(max(times)) if len(times) else None
+
+    def version(self):
+        """ Get a token which changes whenever anything is committed to 
+        the database, by any connection or process, and the time of the 
+        last change (or None). The token is read from the files of the 
+        database (see ``_file_state``), so it can be checked without 
+        touching any tables and is the same for all processes and after
+        restarts. A separate connection which never writes is kept open,
+        so that the WAL index is not removed in between. Returns None if 
+        the changes to the database cannot be tracked. """
+        path = getattr(self, 'path', None)
+        if self.monitor is None or path is None:
+            return None
+        with self.lock:
+            if self.changes['connection'] is None:
+                connection = self.monitor()
+                connection.execute('PRAGMA schema_version').fetchone()
+                self.changes['connection'] = connection
+        state = _file_state(path)
+        if state is None:
+            return None
+        return sha1(repr(state)).hexdigest()[:20], self._modified()
+
+    def pool_status(self):
+        """ Report on the connections held by this database's pool. """
+        pool = self.engine.pool
+        return {'size': pool.size(), 'checkedin': pool.checkedin(),
+                'checkedout': pool.checkedout(), 
+                'overflow': pool.overflow()}
 
     def finalize(self):
+        with self.lock:
+            if self.changes['connection'] is not None:
+                self.changes['connection'].close()
+                self.changes['connection'] = None
         self.engine.dispose()
 
 class TableHandler(object):
-    """ Handle operations on tables. """
+    """ Handle operations on tables. A connection is only checked out 
+    when the table is first used and a transaction is only begun before
+    the first write; call ``close`` when done. """
 
-    def __init__(self, table, engine, meta):
+    def __init__(self, table, engine, meta, database=None):
         self.table = table
-        self.bind = engine.connect()
-        self.tx = self.bind.begin()
+        self.engine = engine
+        self.tx = None
         self.meta = meta
+        self.database = database
+        self._bind = None
+        self.columns = frozenset(table.columns.keys())
+        self._converters = {}
+        self._unique_indexes = {}
+
+    def _invalidate(self):
+        if self.database is not None:
+            self.database.invalidate(self.table.name)
+
+    @property
+    def bind(self):
+        if self._bind is None:
+            self._bind = self.engine.connect() if self.database is None \
+                    else self.database.connect()
+        return self._bind
+
+    def _begin(self):
+        if self.tx is None:
+            self.tx = self.bind.begin()
+
+    @contextmanager
+    def _locked(self):
+        """ Run a block of statements, including DDL, in a transaction 
+        which takes the write lock of the database up front. pysqlite 
+        commits before each DDL statement and only begins transactions 
+        lazily, so ``_begin`` alone does not make setting up tables and 
+        their triggers atomic. Everything is rolled back on errors. """
+        self.commit()
+        dbapi = self.bind.connection.connection
+        level = dbapi.isolation_level
+        dbapi.isolation_level = None
+        try:
+            self._begin()
+            self.bind.execute('BEGIN IMMEDIATE')
+            yield
+            self.commit()
+        finally:
+            if self.tx is not None:
+                self.tx.rollback()
+                self.tx = None
+            dbapi.isolation_level = level
+
+    def _prepare(self):
+        """ Set up the tables which are kept next to this one by 
+        triggers before a write transaction begins: the row counts and,
+        once it has been asked for, the ordinal index. Doing so on the
+        first read would make reads write as well. """
+        if self.tx is not None:
+            return
+        if self._row_count() is None:
+            self._create_row_count()
+        ordinals = getattr(self.database, 'ordinals', ())
+        if ID_COLUMN in self.table.columns and self._ordinal_index() is None \
+                and (self.table.name in ordinals or \
+                     self._has_triggers(self._ordinal_table().name)):
+            self._create_ordinal_index()
 
     def commit(self):
-        self.tx.commit()
+        if self.tx is not None:
+            self.tx.commit()
+            self.tx = None
+
+    def close(self):
+        """ Roll back anything not yet committed and return the 
+        connection to the pool. """
+        if self.tx is not None:
+            self.tx.rollback()
+            self.tx = None
+        if self._bind is not None:
+            self._bind.close()
+            self._bind = None
 
     def drop(self): 
         """ DROP the table. """
-        self.table.drop()
+        self._begin()
+        self.table.drop(bind=self.bind)
+        self.bind.execute('DROP TABLE IF EXISTS %s' 
+                % self._quote(self._ordinal_table().name))
+        prefix = self._frequency_prefix()
+        for (name,) in self.bind.execute("SELECT name FROM sqlite_master "
+                "WHERE type = 'table' AND substr(name, 1, ?) = ? AND "
+                "length(name) = ?", len(prefix), prefix, 
+                len(prefix) + 12).fetchall():
+            self.bind.execute('DROP TABLE %s' % self._quote(name))
+        if self.bind.dialect.has_table(self.bind, ROW_COUNTS):
+            self.bind.execute('DELETE FROM %s WHERE name = ?' 
+                    % self._quote(ROW_COUNTS), self.table.name)
+        self._invalidate()
 
-    def _guess_type(self, column, sample):
+    def _guess_type(self, column, sample, values=()):
         if isinstance(sample, int):
             return Integer
         elif isinstance(sample, float):
             return Float
+        elif len(values):
+            return guess_text_type(values)
         return UnicodeText
 
-    def _type_convert(self, row):
+    def _converter(self, column):
+        if not column in self._converters:
+            convert = lambda value, strict=False: unicode(value)
+            if column in self.table.columns:
+                _type = self.table.columns[column].type
+                for type_, converter in CONVERTERS:
+                    if isinstance(_type, type_):
+                        convert = converter
+                        break
+            self._converters[column] = convert
+        return self._converters[column]
+
+    def _type_convert(self, row, strict=False):
         _row = []
         for k, v in row.items():
             if v is None:
                 _row.append((k, v))
             else:
-                _row.append((k, unicode(v)))
+                _row.append((k, self._converter(k)(v, strict)))
         return dict(_row)
 
     def _ensure_columns(self, row):
-        columns = set(row.keys()) - set(self.table.columns.keys())
-        columns = map(validate_columnname, columns)
+        self._ensure_batch_columns([row])
+
+    def _ensure_batch_columns(self, rows, type_sample=0):
+        """ Create all columns used in a batch of rows which do not 
+        exist yet. Types are guessed from the first row which uses 
+        the column or, if ``type_sample`` is set, from the textual 
+        values found in that many rows. """
+        samples = {}
+        for row in rows:
+            keys = frozenset(row.keys())
+            if keys <= self.columns:
+                continue
+            for column in keys - self.columns:
+                if not column in samples:
+                    samples[column] = row[column]
+        columns = map(validate_columnname, samples.keys())
+        values = dict([(c, []) for c in columns])
+        for row in rows[:type_sample] if len(columns) else []:
+            for column in columns:
+                value = row.get(column)
+                if isinstance(value, basestring) and len(value.strip()):
+                    values[column].append(value)
         for column in columns:
-            _type = self._guess_type(column, row[column])
+            _type = self._guess_type(column, samples[column], 
+                                     values[column])
             log.debug("Creating column: %s (%s) on %r" % (column, 
                 _type, self.table.name))
             col = Column(column, _type)
             col.create(self.table, connection=self.bind)
+        if len(columns):
+            self.columns = frozenset(self.table.columns.keys())
+            self._converters = {}
+            self._invalidate()
 
-    def add_row(self, row):
+    def _batches(self, rows, batch_size, lookahead, type_sample=0):
+        """ Split an iterable of rows into batches of ``batch_size``. 
+        The rows are read ``lookahead`` rows at a time, so that all 
+        new columns in that window are created in one go before any 
+        of them is written. """
+        rows = iter(rows)
+        window_size = max(batch_size, lookahead or 0, type_sample)
+        while True:
+            window = list(islice(rows, window_size))
+            if not len(window):
+                break
+            self._ensure_batch_columns(window, type_sample)
+            for i in xrange(0, len(window), batch_size):
+                yield window[i:i + batch_size]
+
+    def add_row(self, row, strict=False):
         """ Add a row (type: dict). If any of the keys of
         the row are not table columns, they will be type
-        guessed and created.
+        guessed and created. With ``strict``, values which do not fit
+        the type of their column raise a ValueError.
         """
+        self._prepare()
+        self._begin()
         self._ensure_columns(row)
-        row = self._type_convert(row)
+        row = self._type_convert(row, strict)
         self.bind.execute(self.table.insert(row))
 
+    def add_rows(self, rows, batch_size=1000, lookahead=None, 
+                 type_sample=0, strict=False):
+        """ Add an iterable of rows (type: dict), ``batch_size`` rows 
+        at a time. Missing columns are created once per ``lookahead`` 
+        window and each run of rows with the same set of keys is 
+        inserted using a single executemany. For textual input, set 
+        ``type_sample`` to the number of rows from which numeric and 
+        date columns are inferred; values which do not fit the type of 
+        their column are then stored as text. For typed input, set 
+        ``strict`` to refuse such values with a ValueError instead. 
+        Returns the number of rows added.
+        """
+        self._prepare()
+        self._begin()
+        count = 0
+        for batch in self._batches(rows, batch_size, lookahead, 
+                                   type_sample):
+            for keys, group in groupby(batch, lambda r: frozenset(r.keys())):
+                group = [self._type_convert(r, strict) for r in group]
+                self.bind.execute(self.table.insert(), group)
+            count += len(batch)
+        return count
+
+    def _quote(self, name, escape=False):
+        name = self.bind.dialect.identifier_preparer.quote_identifier(name)
+        if escape:
+            name = BIND_PARAMS.sub(lambda m: '\\' + m.group(0), name)
+        return name
+
+    def _unique_index(self, unique):
+        """ Make sure there is a UNIQUE index covering the given columns, 
+        so that they can be used as a conflict target. Returns False if 
+        such an index cannot be created, e.g. because the columns contain
+        duplicate values; a plain index is created instead then. """
+        columns = tuple(sorted(set(unique)))
+        if not columns in self._unique_indexes:
+            if not NATIVE_UPSERT or self.bind.dialect.name != 'sqlite' or \
+                    not all(c in self.table.columns for c in columns):
+                self._unique_indexes[columns] = False
+                return False
+            digest = sha1(u'\0'.join(columns).encode('utf-8'))
+            name = '%s__unique_%s' % (self.table.name, digest.hexdigest()[:12])
+            _columns = ', '.join(map(self._quote, columns))
+            _table = self._quote(self.table.name)
+            # a plain index is left behind by an earlier attempt, which
+            # should not be repeated (and the table scanned) every time.
+            existing = [r[0] for r in self.bind.execute("SELECT name FROM "
+                "sqlite_master WHERE type = 'index' AND name IN (?, ?)",
+                name, name + '_plain')]
+            if len(existing):
+                self._unique_indexes[columns] = name in existing
+                return self._unique_indexes[columns]
+            try:
+                self.bind.execute('CREATE UNIQUE INDEX IF NOT EXISTS %s ON %s (%s)' 
+                    % (self._quote(name), _table, _columns))
+                self._unique_indexes[columns] = True
+            except IntegrityError:
+                log.debug("Not unique: %s on %r" % (columns, self.table.name))
+                self.bind.execute('CREATE INDEX IF NOT EXISTS %s ON %s (%s)' 
+                    % (self._quote(name + '_plain'), _table, _columns))
+                self._unique_indexes[columns] = False
+            self._invalidate()
+        return self._unique_indexes[columns]
+
+    def _upsert(self, unique, keys, rows, strict=False):
+        """ Insert or update a set of rows with the same keys via 
+        INSERT ... ON CONFLICT DO UPDATE. """
+        quote = lambda n: self._quote(n, escape=True)
+        keys = list(keys)
+        columns = [self.table.c[k] for k in keys]
+        names = [quote(c.name) for c in columns]
+        params = ['p%s' % i for i in range(len(columns))]
+        stmt = 'INSERT INTO %s (%s) VALUES (%s) ON CONFLICT (%s) ' % (
+            quote(self.table.name), ', '.join(names),
+            ', '.join(':' + p for p in params),
+            ', '.join(map(quote, unique)))
+        updates = ['%s = excluded.%s' % (n, n) for (c, n) in \
+                   zip(columns, names) if not c.name in unique]
+        if len(updates):
+            stmt += 'DO UPDATE SET ' + ', '.join(updates)
+        else:
+            stmt += 'DO NOTHING'
+        stmt = text(stmt, bindparams=[bindparam(p, type_=c.type) for \
+                                      (p, c) in zip(params, columns)])
+        values = []
+        for row in [self._type_convert(r, strict) for r in rows]:
+            values.append(dict([(p, row[k]) for (p, k) in zip(params, keys)]))
+        self.bind.execute(stmt, values)
+
+    def upsert_rows(self, unique, rows, batch_size=1000, lookahead=None,
+                    type_sample=0, strict=False):
+        """ Add or update an iterable of rows (type: dict) based on the 
+        unique keys, ``batch_size`` rows at a time (see ``add_rows``).
+        Where possible, the unique columns are backed by a UNIQUE index 
+        and the rows are written with a native upsert. Otherwise, each 
+        row is updated or added individually. Returns the number of 
+        rows processed.
+        """
+        self._prepare()
+        self._begin()
+        count = 0
+        for batch in self._batches(rows, batch_size, lookahead, 
+                                   type_sample):
+            native = self._unique_index(unique)
+            # the conflict target has to name each column only once.
+            target = tuple(sorted(set(unique)))
+            # NULL never conflicts, so those rows take the slow path
+            # in order to match on IS NULL.
+            key = lambda r: (frozenset(r.keys()), 
+                             any(r.get(u) is None for u in unique))
+            for (keys, nulls), group in groupby(batch, key):
+                if native and not nulls:
+                    self._upsert(target, keys, list(group), strict)
+                    continue
+                for row in group:
+                    if not self.update_row(unique, row, strict):
+                        self.add_row(row, strict)
+            count += len(batch)
+        return count
+
     def args_to_clause(self, args):
         clauses = []
         for k, v in args.items():
+            v = self._converter(k)(v) if v is not None else v
             clauses.append(self.table.c[k] == v)
         return and_(*clauses)
 
-    def update_row(self, unique, row):
+    def keyset_clause(self, keys, values):
+        """ Build a clause matching all rows which come after the row 
+        with the given ``values`` in the order defined by ``keys``, a 
+        list of (column, descending) tuples. NULLs are ordered as SQLite
+        does, i.e. before all other values. """
+        values = [self._converter(c.name)(v) if isinstance(v, basestring) \
+                  else v for ((c, d), v) in zip(keys, values)]
+        clauses = []
+        for i, ((column, descending), value) in enumerate(zip(keys, values)):
+            if value is None:
+                after = literal_column("0") if descending else column != None
+            elif descending:
+                after = or_(column < value, column == None)
+            else:
+                after = column > value
+            equal = [c == v for ((c, d), v) in zip(keys[:i], values[:i])]
+            clauses.append(and_(*(equal + [after])))
+        return or_(*clauses)
+
+    def _create_triggers(self, prefix, names, triggers):
+        """ Create a trigger on the table for each (event, condition, 
+        action) tuple given, with ``names`` substituted into each part. """
+        for (event, when, action) in triggers:
+            names['trigger'] = self._quote('%s_%s' % (prefix, 
+                                           event.split()[0].lower()))
+            self.bind.execute(('CREATE TRIGGER IF NOT EXISTS %(trigger)s '
+                'AFTER ' + event + ' ON %(table)s ' + when + ' BEGIN ' 
+                + action + '; END') % names)
+        self._invalidate()
+
+    def _has_triggers(self, prefix):
+        # triggers are dropped along with their table, e.g. when it is 
+        # replaced through a raw SQL query.
+        return self.bind.execute("SELECT 1 FROM sqlite_master WHERE "
+            "type = 'trigger' AND name = ?", prefix + '_delete').scalar() \
+            is not None
+
+    def _row_count_names(self):
+        return '%s_%s' % (ROW_COUNTS, self.table.name), dict(
+                counts=self._quote(ROW_COUNTS), 
+                table=self._quote(self.table.name),
+                name="'%s'" % self.table.name.replace("'", "''"))
+
+    def _row_count(self):
+        """ Get the number of rows in the table and a version number 
+        which changes whenever the table is modified. Both are kept in a
+        metadata table by triggers, which are set up before the first 
+        write (see ``_prepare``); returns None until then. """
+        prefix, names = self._row_count_names()
+        if self._has_triggers(prefix):
+            row = self.bind.execute('SELECT rows, version FROM %(counts)s '
+                                    'WHERE name = %(name)s' % names).fetchone()
+            if row is not None:
+                return tuple(row)
+        return None
+
+    def _create_row_count(self):
+        prefix, names = self._row_count_names()
+        with self._locked():
+            self.bind.execute('CREATE TABLE IF NOT EXISTS %(counts)s (name '
+                'TEXT PRIMARY KEY, rows INTEGER NOT NULL, version INTEGER '
+                'NOT NULL)' % names)
+            update = 'UPDATE %(counts)s SET rows = rows %(change)s, ' \
+                     'version = version + 1 WHERE name = %(name)s'
+            self._create_triggers(prefix, names,
+                [(event, '', update % dict(names, change=change)) for \
+                 (event, change) in [('INSERT', '+ 1'), ('DELETE', '- 1'),
+                                     ('UPDATE', '')]])
+            # versions start at random, so that counts cached for an 
+            # earlier table of the same name are not mistaken as current.
+            self.bind.execute('INSERT OR REPLACE INTO %(counts)s (name, '
+                'rows, version) SELECT %(name)s, count(*), abs(random() / 2) '
+                'FROM %(table)s' % names)
+
+    def count(self, clause=None):
+        """ Count the rows matching the given clause. The total is 
+        read from the row counts kept by triggers, filtered counts are
+        cached until the table is modified. Tables which have not been 
+        written to since the row counts were introduced are counted 
+        directly. """
+        counted = self._row_count()
+        if counted is None:
+            statement = select([func.count()], clause, self.table)
+            return self.bind.execute(statement).scalar()
+        rows, version = counted
+        if clause is None or not len(getattr(clause, 'clauses', [clause])):
+            return rows
+        compiled = clause.compile(bind=self.bind)
+        key = (self.table.name, unicode(compiled), 
+               tuple(sorted(compiled.params.items())), version)
+        counts = getattr(self.database, 'counts', None)
+        if counts is not None:
+            count = counts.get(key)
+            if count is not None:
+                return count
+        statement = select([func.count()], clause, self.table)
+        count = self.bind.execute(statement).scalar()
+        if counts is not None:
+            counts[key] = count
+        return count
+
+    def _frequency_prefix(self):
+        return '%sdistinct_%s_' % (INTERNAL_PREFIX, self.table.name)
+
+    def frequencies(self, column):
+        """ Get a table holding each distinct value of the given column
+        with the number of its occurrences, i.e. the result of a GROUP BY
+        query. It is computed on first use and then kept up to date by 
+        triggers, so that it never needs to be recomputed. """
+        column = self.table.c[column]
+        digest = sha1(column.name.encode('utf-8')).hexdigest()[:12]
+        frequencies = Table(self._frequency_prefix() + digest, MetaData(),
+                            Column('value', column.type),
+                            Column('_count', Integer))
+        names = dict(frequencies=self._quote(frequencies.name),
+                     table=self._quote(self.table.name),
+                     column=self._quote(column.name),
+                     values=self._quote(frequencies.name + '_value'),
+                     counts=self._quote(frequencies.name + '_count'))
+        if self._has_triggers(frequencies.name):
+            return frequencies
+        with self._locked():
+            # another request may have set up the table in the meantime.
+            if not self._has_triggers(frequencies.name):
+                self._create_frequencies(frequencies.name, names)
+        return frequencies
+
+    def _create_frequencies(self, prefix, names):
+        self.bind.execute('DROP TABLE IF EXISTS %(frequencies)s' % names)
+        self.bind.execute('CREATE TABLE %(frequencies)s (value, _rows '
+            'INTEGER NOT NULL, _count INTEGER NOT NULL)' % names)
+        self.bind.execute('CREATE UNIQUE INDEX %(values)s ON '
+            '%(frequencies)s (value)' % names)
+        self.bind.execute('CREATE INDEX %(counts)s ON %(frequencies)s '
+            '(_count)' % names)
+        # NULLs are kept with a _count of zero, like COUNT(column) does, 
+        # but removed once no rows with NULL values are left.
+        add = 'INSERT INTO %(frequencies)s (value, _rows, _count) SELECT ' \
+              'NEW.%(column)s, 0, 0 WHERE NOT EXISTS (SELECT 1 FROM ' \
+              '%(frequencies)s WHERE value IS NEW.%(column)s); ' \
+              'UPDATE %(frequencies)s SET _rows = _rows + 1, _count = ' \
+              '_count + (NEW.%(column)s IS NOT NULL) WHERE value IS ' \
+              'NEW.%(column)s'
+        remove = 'UPDATE %(frequencies)s SET _rows = _rows - 1, _count = ' \
+                 '_count - (OLD.%(column)s IS NOT NULL) WHERE value IS ' \
+                 'OLD.%(column)s; DELETE FROM %(frequencies)s WHERE value ' \
+                 'IS OLD.%(column)s AND _rows < 1'
+        self._create_triggers(prefix, names, [
+            ('INSERT', '', add), ('DELETE', '', remove),
+            ('UPDATE OF %(column)s', 
+             'WHEN OLD.%(column)s IS NOT NEW.%(column)s', 
+             remove + '; ' + add)])
+        self.bind.execute('INSERT INTO %(frequencies)s (value, _rows, _count) '
+            'SELECT %(column)s, count(*), count(%(column)s) FROM %(table)s '
+            'GROUP BY %(column)s' % names)
+
+    def _ordinal_table(self):
+        return Table(INTERNAL_PREFIX + 'ordinal_' + self.table.name, MetaData(),
+                     Column('ordinal', Integer, primary_key=True),
+                     Column('id', Integer, nullable=False))
+
+    def _ordinal_names(self, ordinal):
+        return dict(ordinal=self._quote(ordinal.name), 
+                    table=self._quote(self.table.name),
+                    id=self._quote(ID_COLUMN))
+
+    def _ordinal_index(self):
+        """ Get the ordinal index of the table, which maps row 
+        positions to row IDs, if it exists and is up to date, or None. 
+        It is kept by triggers: rows inserted in ID order are appended, 
+        anything else removes the first position so that the index is 
+        rebuilt before the next write (see ``_prepare``). """
+        ordinal = self._ordinal_table()
+        valid = 'SELECT EXISTS (SELECT 1 FROM %(ordinal)s WHERE ' \
+                'ordinal = 1) OR NOT EXISTS (SELECT 1 FROM %(table)s)' \
+                % self._ordinal_names(ordinal)
+        if self._has_triggers(ordinal.name) and \
+                self.bind.execute(valid).scalar():
+            return ordinal
+        return None
+
+    def _create_ordinal_index(self):
+        ordinal = self._ordinal_table()
+        names = self._ordinal_names(ordinal)
+        with self._locked():
+            ordinal.create(bind=self.bind, checkfirst=True)
+            # ids are appended in ascending order, so the last one is 
+            # found through the primary key. Only primary key lookups are
+            # used, as the trigger runs for every inserted row.
+            last = '(SELECT id FROM %(ordinal)s ORDER BY ordinal DESC ' \
+                   'LIMIT 1)'
+            self._create_triggers(ordinal.name, names, [
+                ('INSERT', '', 'DELETE FROM %(ordinal)s WHERE ordinal = 1 '
+                    'AND NEW.%(id)s <= ' + last + '; INSERT INTO '
+                    '%(ordinal)s (id) SELECT NEW.%(id)s WHERE NEW.%(id)s > '
+                    + last),
+                ('DELETE', '', 'DELETE FROM %(ordinal)s'),
+                ('UPDATE OF %(id)s', 'WHEN OLD.%(id)s != NEW.%(id)s', 
+                    'DELETE FROM %(ordinal)s')])
+            self.bind.execute('DELETE FROM %(ordinal)s' % names)
+            self.bind.execute('INSERT INTO %(ordinal)s (id) SELECT %(id)s '
+                              'FROM %(table)s ORDER BY %(id)s' % names)
+
+    def ordinal_clause(self, position):
+        """ Build a clause matching the row at the given (1-based) 
+        position in ID order, using the ordinal index instead of 
+        skipping over all preceding rows. Reads do not write, so if the
+        index is missing or out of date, it is only noted to be set up 
+        before the next write and None is returned. """
+        ordinal = self._ordinal_index()
+        if ordinal is None:
+            if self.database is not None:
+                self.database.ordinals.add(self.table.name)
+            return None
+        return self.table.c[ID_COLUMN] == select([ordinal.c.id], 
+                ordinal.c.ordinal == position).as_scalar()
+
+    def update_row(self, unique, row, strict=False):
         """ Update a row (type: dict) based on the unique keys.
 
         If any of the keys of the row are not table columns, they will 
@@ -118,9 +858,11 @@ class TableHandler(object):
         """
         if not len(unique):
             return False
+        self._prepare()
+        self._begin()
         clause = dict([(u, row.get(u)) for u in unique])
         self._ensure_columns(row)
-        row = self._type_convert(row)
+        row = self._type_convert(row, strict)
         try:
             stmt = self.table.update(self.args_to_clause(clause), row)
             rp = self.bind.execute(stmt)
@@ -129,6 +871,184 @@ class TableHandler(object):
             log.warn("UPDATE: filter column does not exist: %s" % ke)
             return False
 
+def _file_state(path):
+    """ Describe the committed state of a database from its files: 
+    the identity of the file and either the change counter in its header,
+    which is incremented by each commit, or, in WAL mode, the number of 
+    valid frames and the salts in the header of the WAL index. These 
+    are not changed by checkpoints, which only copy frames over. Returns 
+    None if the state cannot be read consistently. """
+    try:
+        with open(path, 'rb') as fh:
+            stat = os.fstat(fh.fileno())
+            state = [stat.st_dev, stat.st_ino]
+            if not os.path.exists(path + '-wal'):
+                return state + [fh.read(28)[24:]]
+        with open(path + '-shm', 'rb') as fh:
+            # the header is kept twice and written one copy after the 
+            # other, so a torn read shows as a mismatch.
+            for attempt in range(10):
+                fh.seek(0)
+                header = fh.read(96)
+                if len(header) == 96 and header[:48] == header[48:] \
+                        and header[12] == '\x01':
+                    return state + [header[16:40]]
+    except (IOError, OSError):
+        pass
+    return None
+
+def _file_id(path):
+    """ Identify a database file, so that a cached handler can tell 
+    if the file has been deleted or replaced underneath it. """
+    try:
+        stat = os.stat(path)
+        return (stat.st_dev, stat.st_ino)
+    except OSError:
+        return None
+
+class DatabaseHandlerCache(object):
+    """ A bounded, thread-safe cache of DatabaseHandlers. Handlers
+    which have not been used for ``timeout`` seconds or which have to 
+    make room for newer ones are evicted and their engines disposed. 
+    """
+
+    def __init__(self, size=100, timeout=60*10):
+        self.size = size
+        self.timeout = timeout
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _evict(self, key):
+        handler, file_id, atime = self._entries.pop(key)
+        log.debug("Evicting handler: %s" % handler.path)
+        handler.finalize()
+
+    def _expire(self, now):
+        # entries are kept in order of last access, so we only need
+        # to look at the oldest ones.
+        while len(self._entries):
+            key = next(iter(self._entries))
+            handler, file_id, atime = self._entries[key]
+            if atime >= now - self.timeout and \
+                    len(self._entries) <= self.size:
+                break
+            self._evict(key)
+
+    def get(self, key):
+        """ Return the cached handler for ``key`` or None. """
+        with self._lock:
+            if not key in self._entries:
+                return None
+            handler, file_id, atime = self._entries.pop(key)
+            now = time.time()
+            current_id = _file_id(handler.path)
+            if atime < now - self.timeout or \
+                    (file_id is not None and current_id != file_id):
+                log.debug("Stale handler: %s" % handler.path)
+                handler.finalize()
+                return None
+            self._entries[key] = (handler, file_id or current_id, now)
+            return handler
+
+    def put(self, key, handler):
+        """ Cache a handler. If another thread has beaten us to it, 
+        the new handler is disposed and the cached one is returned. """
+        with self._lock:
+            if key in self._entries:
+                handler.finalize()
+                return self._entries[key][0]
+            now = time.time()
+            self._entries[key] = (handler, _file_id(handler.path), now)
+            self._expire(now)
+            return handler
+
+    def invalidate(self, match):
+        """ Evict all handlers for which ``match(key)`` is true. """
+        with self._lock:
+            for key in [k for k in self._entries if match(k)]:
+                self._evict(key)
+
+    def handlers(self):
+        """ List all cached handlers. """
+        with self._lock:
+            return [e[0] for e in self._entries.values()]
+
+    def __len__(self):
+        return len(self._entries)
+
+class ResultCache(object):
+    """ A bounded, thread-safe cache of rendered query results. The 
+    total size of all results is kept within ``budget`` bytes by 
+    evicting the least recently used ones; results larger than 
+    ``entry_limit`` are not cached at all. Each result is stored with 
+    the version of its database and is only returned for that version,
+    so results are never served after the database has been changed. 
+    """
+
+    def __init__(self, budget, entry_limit, log_interval=None):
+        self.budget = budget
+        self.entry_limit = min(entry_limit, budget)
+        self.log_interval = log_interval
+        self.size = 0
+        self.hits = self.misses = self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._logged = time.time()
+
+    def _report(self):
+        # log the stats every ``log_interval`` seconds, as the cache is 
+        # shared by all requests and cannot be inspected from outside.
+        if not self.log_interval or \
+                time.time() - self._logged < self.log_interval:
+            return
+        self._logged = time.time()
+        log.info("Result cache: %r" % self.stats())
+
+    def get(self, key, version):
+        """ Return the result stored for ``key`` at ``version`` or None. 
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and entry[0] == version:
+                self._entries[key] = entry
+                self.hits += 1
+                result = entry[1]
+            else:
+                if entry is not None:
+                    self.size -= entry[2]
+                self.misses += 1
+                result = None
+        self._report()
+        return result
+
+    def put(self, key, version, result, size):
+        """ Store a result of ``size`` bytes, if it is small enough. """
+        if size > self.entry_limit:
+            return False
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry[2]
+            self._entries[key] = (version, result, size)
+            self.size += size
+            while self.size > self.budget:
+                key, entry = self._entries.popitem(last=False)
+                self.size -= entry[2]
+                self.evictions += 1
+        self._report()
+        return True
+
+    def stats(self):
+        """ Report on the use of the cache. """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 
+                    'entries': len(self._entries), 'size': self.size,
+                    'budget': self.budget}
+
+    def __len__(self):
+        return len(self._entries)
+
 class DatabaseHandlerFactory(object):
     """ An engine factory will generate a database with
     the given name and return an SQLAlchemy engine bound
@@ -151,7 +1071,6 @@ class DatabaseHandlerFactory(object):
         pass
 
 
-import sqlite3
 def authorizer_ro(action_code, tname, cname, sql_location, trigger):
     #print action_code, tname, cname, sql_location, trigger
     # thanks to ScraperWiki 
@@ -163,7 +1082,11 @@ def authorizer_ro(action_code, tname, cname, sql_location, trigger):
     if action_code in readonlyops:
         return sqlite3.SQLITE_OK
     if action_code == sqlite3.SQLITE_PRAGMA:
-        if tname in ["table_info", "index_list", "index_info"]:
+        if tname in ["table_info", "index_list", "index_info",
+                     "foreign_key_list"]:
+            return sqlite3.SQLITE_OK
+        # reading (but not setting) the schema version is harmless.
+        if tname == "schema_version" and cname is None:
             return sqlite3.SQLITE_OK
     log.debug("Unauthorized query: %s / %s / %c " % (action_code, tname, cname))
     return sqlite3.SQLITE_DENY
@@ -180,8 +1103,59 @@ def authorizer_rw(action_code, tname, cname, sql_location, trigger):
         return sqlite3.SQLITE_OK
     return authorizer_ro(action_code, tname, cname, sql_location, trigger)
 
+def authorizer_all(action_code, tname, cname, sql_location, trigger):
+    return sqlite3.SQLITE_OK
+
+def _restrict_connection(dbapi_connection, connection_record, proxy):
+    # connections are handed out read-only unless a handler asks 
+    # for something else.
+    dbapi_connection.set_authorizer(authorizer_ro)
+
+def _detach_databases(dbapi_connection, connection_record):
+    # don't let databases attached by one request leak into the next
+    # one to use a pooled connection.
+    for alias in connection_record.info.pop('attached', []):
+        try:
+            dbapi_connection.execute('DETACH DATABASE ?', (alias,))
+        except sqlite3.Error, e:
+            log.warn("Cannot detach %s: %s" % (alias, e))
+            connection_record.invalidate(e)
+
+# files kept next to an SQLite database while it is in use.
+SQLITE_SIDECARS = ('-wal', '-shm', '-journal')
+
 class SQLiteDatabaseHandlerFactory(DatabaseHandlerFactory):
 
+    def __init__(self, app):
+        super(SQLiteDatabaseHandlerFactory, self).__init__(app)
+        self._cache = None
+        self._results = None
+
+    @property
+    def cache(self):
+        # created lazily as ``app`` may be a proxy to the current app.
+        if self._cache is None:
+            self._cache = DatabaseHandlerCache(
+                size=self.app.config.get('DATABASE_CACHE_SIZE', 100),
+                timeout=self.app.config.get('DATABASE_CACHE_TIMEOUT', 600))
+        return self._cache
+
+    @property
+    def results(self):
+        """ The result cache, or None unless RESULT_CACHE_SIZE is set. """
+        budget = self.app.config.get('RESULT_CACHE_SIZE', 0)
+        if not budget:
+            return None
+        if self._results is None:
+            self._results = ResultCache(budget,
+                self.app.config.get('RESULT_CACHE_ENTRY_LIMIT', 1024 * 1024),
+                self.app.config.get('RESULT_CACHE_LOG_INTERVAL'))
+        return self._results
+
+    def _cache_key(self, user_name, database_name):
+        prefix = self.app.config.get('SQLITE_DIR', '/tmp')
+        return (prefix, user_name, database_name)
+
     def _user_directory(self, user_name):
         prefix = self.app.config.get('SQLITE_DIR', '/tmp')
         user_directory = os.path.join(prefix, validate_username(user_name))
@@ -198,7 +1172,8 @@ class SQLiteDatabaseHandlerFactory(DatabaseHandlerFactory):
         user_directory = self._user_directory(user_name)
         log.debug("Directory listing: %s" % user_directory)
         return (os.path.basename(db).rsplit('.', 1)[0] for db in \
-                iglob(user_directory + '/*'))
+                iglob(user_directory + '/*') if not \
+                db.endswith(SQLITE_SIDECARS))
 
     def database_path(self, user_name, database_name):
         database_name = validate_dbname(database_name)
@@ -213,24 +1188,69 @@ class SQLiteDatabaseHandlerFactory(DatabaseHandlerFactory):
             os.makedirs(db_directory)
         return os.path.join(db_directory, 'defaultdb.sqlite')
 
+    def _pragmas(self, user_name, database_name):
+        """ Collect the PRAGMA statements to run on each new connection
+        to the given database. """
+        pragmas = dict(self.app.config.get('SQLITE_PRAGMAS', {}))
+        profiles = self.app.config.get('SQLITE_PRAGMA_PROFILES', {})
+        pragmas.update(profiles.get(user_name, {}))
+        pragmas.update(profiles.get(user_name + '/' + database_name, {}))
+        return ['PRAGMA %s = %s' % (k, v) for k, v in sorted(pragmas.items())]
+
     def create(self, user_name, database_name, authorizer=authorizer_rw):
+        key = self._cache_key(user_name, database_name)
+        handler = self.cache.get(key)
+        if handler is None:
+            handler = self.cache.put(key, 
+                self._create(user_name, database_name))
+        return handler.using(authorizer)
+
+    def _create(self, user_name, database_name):
         try:
             path = self.database_path(user_name, database_name)
         except UserNotFound:
             self._create_user_directory(user_name)
             path = self.database_path(user_name, database_name)
 
+        pragmas = self._pragmas(user_name, database_name)
         def make_conn():
-            conn = sqlite3.connect(path, timeout=10)
-            if authorizer is not None:
-                conn.set_authorizer(authorizer)
+            # pooled connections are passed between threads, but only 
+            # ever used by one at a time.
+            conn = sqlite3.connect(path, timeout=10, 
+                                   check_same_thread=False)
+            for pragma in pragmas:
+                try:
+                    conn.execute(pragma)
+                except sqlite3.Error, e:
+                    log.warn("Cannot set %s on %s: %s" % (pragma, path, e))
             return conn
         log.debug("Loading SQLite DB: %s" % path)
-        handler = DatabaseHandler(create_engine('sqlite:///' + path, 
-            creator=make_conn))
-        handler.authorizer = authorizer
+        config = self.app.config
+        engine = create_engine('sqlite:///' + path, creator=make_conn,
+            poolclass=QueuePool,
+            pool_size=config.get('SQLITE_POOL_SIZE', 5),
+            max_overflow=config.get('SQLITE_POOL_OVERFLOW', 10),
+            pool_timeout=config.get('SQLITE_POOL_TIMEOUT', 30))
+        event.listen(engine.pool, 'checkout', _restrict_connection)
+        event.listen(engine.pool, 'checkin', _detach_databases)
+        handler = DatabaseHandler(engine, authorizer_rw, monitor=make_conn)
+        handler.path = path
+        handler.counts = LRUTimeoutCache(config.get('COUNT_CACHE_SIZE', 1000),
+                                         config.get('COUNT_CACHE_TIMEOUT', 60))
         return handler
 
+    def invalidate(self, user_name, database_name):
+        """ Forget all cached handlers for a database, e.g. because
+        it has been deleted or replaced. """
+        prefix = self.app.config.get('SQLITE_DIR', '/tmp')
+        self.cache.invalidate(lambda k: k == \
+                (prefix, user_name, database_name))
+
+    def pool_status(self):
+        """ Report the pool status of all open databases by path. """
+        return dict([(h.path, h.pool_status()) for h in \
+                     self.cache.handlers()])
+
     def create_readonly(self, user_name, database_name):
         return self.create(user_name, database_name, authorizer_ro)
 
@@ -244,5 +1264,6 @@ class SQLiteDatabaseHandlerFactory(DatabaseHandlerFactory):
         path = self.database_path(user_name, database_name)
         log.debug("Attaching SQLite DB: %s (as %s)" % (path, alias))
         connection.execute("ATTACH DATABASE ? AS ?", path, alias)
+        connection.connection.info.setdefault('attached', []).append(alias)
         connection.connection.set_authorizer(authorizer)
         return connection
@@ -8,6 +8,66 @@ SECRET = 'foobar'
 
 SQLITE_DIR = '/tmp'
 
+# PRAGMAs set on every new SQLite connection. They can be overridden for
+# all databases of a user ('user') or a single database ('user/database') 
+# in SQLITE_PRAGMA_PROFILES, e.g. {'hugo/scratch': {'synchronous': 'OFF'}}
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -16000,
+    'mmap_size': 256 * 1024 * 1024,
+    'temp_store': 'MEMORY'
+    }
+SQLITE_PRAGMA_PROFILES = {}
+
+# connections kept open per database, the number of extra connections 
+# allowed under load and how many seconds to wait for a free one.
+SQLITE_POOL_SIZE = 5
+SQLITE_POOL_OVERFLOW = 10
+SQLITE_POOL_TIMEOUT = 30
+
+# number of open database handlers to keep around and the number of 
+# seconds after which an unused handler is closed.
+DATABASE_CACHE_SIZE = 100
+DATABASE_CACHE_TIMEOUT = 600
+
+# number of filtered row counts to cache and the number of seconds for
+# which they are kept; cached counts are dropped when a table changes.
+COUNT_CACHE_SIZE = 1000
+COUNT_CACHE_TIMEOUT = 60
+
+# size in bytes of the cache for results of reads and SELECT queries 
+# (0 disables it) and the size of the largest result which is cached.
+RESULT_CACHE_SIZE = 0
+RESULT_CACHE_ENTRY_LIMIT = 1024 * 1024
+# whether results of raw SQL queries are cached as well. Queries which
+# call functions such as random() or datetime('now') never are.
+RESULT_CACHE_SQL = False
+# seconds between log messages (at INFO level) with the hits, misses 
+# and size of the result cache; None disables them.
+RESULT_CACHE_LOG_INTERVAL = 300
+
+# size in bytes of the chunks in which tables are sent to clients.
+OUTPUT_CHUNK_SIZE = 64 * 1024
+
+# encodings in which tables may be compressed, in order of preference
+# ('zstd' needs the zstandard package), the level for each encoding and
+# the size in bytes below which responses are sent uncompressed. Raw
+# SQLite downloads are only compressed if COMPRESS_SQLITE_DOWNLOAD is set.
+OUTPUT_COMPRESSION = ['zstd', 'gzip']
+OUTPUT_COMPRESSION_LEVEL = {'gzip': 6, 'zstd': 3}
+OUTPUT_COMPRESSION_MIN_SIZE = 1024
+COMPRESS_SQLITE_DOWNLOAD = False
+
+# number of rows written to the database in one go during uploads and
+# the number of rows scanned ahead for new columns.
+INGEST_BATCH_SIZE = 1000
+INGEST_LOOKAHEAD = 5000
+
+# number of rows of a textual (e.g. CSV) upload from which integer, float
+# and date columns are inferred. Set to 0 to store all such data as text.
+TYPE_INFERENCE_SAMPLE = 1000
+
 AUTHORIZATION = {
     'self': ['read', 'write', 'delete'],
     'user': ['read'],
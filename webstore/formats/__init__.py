@@ -4,9 +4,13 @@ from webstore.formats.ft_json import json_request, \
         json_table, json_message
 from webstore.formats.ft_jsontuples import jsontuples_request, \
         jsontuples_table, jsontuples_message
+from webstore.formats.ft_ndjson import ndjson_request, \
+        ndjson_table, ndjson_message
 from webstore.formats.ft_basic import basic_request, \
         basic_table, basic_message
 from webstore.formats.ft_gviz import gviz_table
+from webstore.formats.ft_columnar import arrow_table, parquet_table
+from webstore.formats.compression import compress
 
 SQLITE = 'application/x-sqlite3'
 
@@ -17,11 +21,17 @@ MIME_TYPES = {
         'application/json+tuples': 'jsontuples',
         'text/javascript': 'json',
         'text/javascript+tuples': 'jsontuples',
+        'application/x-ndjson': 'ndjson',
         'text/csv': 'csv',
         'application/json+vnd.google.gviz': 'gviz',
+        'application/vnd.apache.arrow.stream': 'arrow',
+        'application/vnd.apache.parquet': 'parquet',
         SQLITE: 'db'
         }
 
+# request formats in which all values arrive as strings.
+TEXT_FORMATS = ['csv', 'html']
+
 def response_format(request, fmt):
     """ 
     Use HTTP Accept headers (and suffix workarounds) to 
@@ -34,22 +44,37 @@ def response_format(request, fmt):
         return fmt
     return MIME_TYPES.get(best)
 
-def render_table(request, table, keys, format, headers=None):
+def render_table(request, table, keys, format, headers=None, types=None,
+                 compression=True):
     """ 
-    Render a table, which is defined as an iterable of dicts 
-    with (at most) the keys in ``keys``.
+    Render a table, which is defined as an iterable of tuples 
+    with the values for ``keys``. Small tables may also be given 
+    as a list of dicts with (at most) the keys in ``keys``. If known, 
+    ``types`` holds the SQLAlchemy type of each column. Unless 
+    ``compression`` is False, the response is compressed if the 
+    client accepts it.
     """
+    if isinstance(table, list):
+        table = [tuple(r.get(k) for k in keys) if isinstance(r, dict) \
+                 else r for r in table]
     format = response_format(request, format)
     if format == 'csv':
-        return csv_table(table, keys, headers=headers)
+        response = csv_table(table, keys, headers=headers)
     elif format == 'json':
-        return json_table(table, keys, headers=headers)
+        response = json_table(table, keys, headers=headers)
     elif format == 'jsontuples':
-        return jsontuples_table(table, keys, headers=headers)
+        response = jsontuples_table(table, keys, headers=headers)
+    elif format == 'ndjson':
+        response = ndjson_table(table, keys, headers=headers)
     elif format == 'gviz':
-        return gviz_table(table, keys, headers=headers)
+        response = gviz_table(table, keys, headers=headers, types=types)
+    elif format == 'arrow':
+        response = arrow_table(table, keys, headers=headers, types=types)
+    elif format == 'parquet':
+        response = parquet_table(table, keys, headers=headers, types=types)
     else:
-        return basic_table(table, keys, headers=headers)
+        response = basic_table(table, keys, headers=headers)
+    return compress(request, response) if compression else response
 
 def render_message(request, message, format,
         state='success', code=200, url=None):
@@ -64,6 +89,8 @@ def render_message(request, message, format,
         return json_message(message, state=state, url=url, code=code)
     elif format == 'jsontuples':
         return jsontuples_message(message, state=state, url=url, code=code)
+    elif format == 'ndjson':
+        return ndjson_message(message, state=state, url=url, code=code)
     else:
         return basic_message(message, state=state, url=url, code=code)
 
@@ -89,6 +116,8 @@ def read_request(request, format):
         return json_request(request)
     elif format == 'jsontuples':
         return jsontuples_request(request)
+    elif format == 'ndjson':
+        return ndjson_request(request)
     else:
         return basic_request(request)
 
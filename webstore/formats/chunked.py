@@ -0,0 +1,22 @@
+from flask import current_app
+
+# size in bytes of the first chunk of a response, which is sent early 
+# so that clients see data while the rest is being generated.
+FIRST_CHUNK_SIZE = 1024
+
+def chunk_size():
+    return current_app.config.get('OUTPUT_CHUNK_SIZE', 64 * 1024)
+
+def chunked(pieces, size, first=FIRST_CHUNK_SIZE):
+    """ Join the strings generated by ``pieces`` into chunks of at least
+    ``size`` bytes (except for the first and the last one), so that the
+    server does not have to write each row separately. """
+    buffer, length, limit = [], 0, min(first, size)
+    for piece in pieces:
+        buffer.append(piece)
+        length += len(piece)
+        if length >= limit:
+            yield ''.join(buffer)
+            buffer, length, limit = [], 0, size
+    if len(buffer):
+        yield ''.join(buffer)
@@ -0,0 +1,102 @@
+import zlib
+from itertools import chain
+
+from flask import current_app
+from werkzeug.wsgi import ClosingIterator
+
+from webstore.formats.chunked import chunked, chunk_size
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# compression levels used unless OUTPUT_COMPRESSION_LEVEL says otherwise.
+LEVELS = {'gzip': 6, 'zstd': 3}
+
+# formats which are compressed already.
+COMPRESSED_TYPES = ['application/vnd.apache.parquet']
+
+def _gzip(level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return (compressor.compress,
+            lambda: compressor.flush(zlib.Z_SYNC_FLUSH),
+            compressor.flush)
+
+def _zstd(level):
+    compressor = zstandard.ZstdCompressor(level=level).compressobj()
+    return (compressor.compress,
+            lambda: compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK),
+            compressor.flush)
+
+ENCODERS = {'gzip': _gzip}
+if zstandard is not None:
+    ENCODERS['zstd'] = _zstd
+
+def accepted_encoding(request, encodings):
+    """ Pick the encoding the client prefers among ``encodings``, which
+    are given in the order preferred by the server. Encodings with a
+    quality of zero are refused. """
+    best, best_quality = None, 0
+    for encoding in encodings:
+        quality = request.accept_encodings[encoding]
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+def _generator(pieces, encoder):
+    # every chunk is flushed, so that clients can decode the data as
+    # it arrives instead of waiting for the end of the response.
+    compress, flush, finish = encoder
+    for piece in pieces:
+        data = compress(piece) + flush()
+        if len(data):
+            yield data
+    yield finish()
+
+def compress(request, response):
+    """
+    Compress the body of ``response`` as it is sent, using an encoding
+    from the request's ``Accept-Encoding`` header. Responses smaller
+    than ``OUTPUT_COMPRESSION_MIN_SIZE`` are left as they are.
+    """
+    config = current_app.config
+    encodings = [e for e in config.get('OUTPUT_COMPRESSION', []) \
+                 if e in ENCODERS]
+    if not len(encodings) or response.status_code != 200 or \
+            'Content-Encoding' in response.headers or \
+            response.mimetype in COMPRESSED_TYPES:
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = accepted_encoding(request, encodings)
+    if encoding is None:
+        return response
+
+    # read ahead until the response is known to be large enough.
+    close = getattr(response.response, 'close', None)
+    pieces = response.iter_encoded()
+    head, length = [], 0
+    minimum = config.get('OUTPUT_COMPRESSION_MIN_SIZE', 1024)
+    for piece in pieces:
+        head.append(piece)
+        length += len(piece)
+        if length >= minimum:
+            break
+    else:
+        response.response = ClosingIterator(head, close)
+        response.direct_passthrough = True
+        response.headers['Content-Length'] = str(length)
+        return response
+
+    levels = dict(LEVELS)
+    levels.update(config.get('OUTPUT_COMPRESSION_LEVEL', {}))
+    encoder = ENCODERS[encoding](levels[encoding])
+    pieces = chunked(chain(head, pieces), chunk_size())
+    response.response = ClosingIterator(_generator(pieces, encoder), close)
+    response.direct_passthrough = True
+    response.headers['Content-Encoding'] = encoding
+    response.headers.pop('Content-Length', None)
+    etag, weak = response.get_etag()
+    if etag is not None:
+        response.set_etag('%s-%s' % (etag, encoding), weak)
+    return response
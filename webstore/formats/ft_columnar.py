@@ -0,0 +1,159 @@
+import cPickle
+import tempfile
+from datetime import date, datetime
+from itertools import islice, chain
+
+from flask import Response
+from sqlalchemy import types as sqltypes
+
+# number of rows in each record batch or Parquet row group.
+BATCH_SIZE = 10000
+
+class _Sink(object):
+    """ A write-only file which collects the output of an Arrow writer
+    until it is drained into the response. """
+
+    closed = False
+
+    def __init__(self):
+        self.parts = []
+        self.position = 0
+
+    def write(self, data):
+        data = data.tobytes() if isinstance(data, memoryview) else str(data)
+        self.parts.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def drain(self):
+        data = ''.join(self.parts)
+        self.parts = []
+        return data
+
+def _arrow_type(pa, type_, values):
+    """ Map a column to an Arrow type, based on its SQLAlchemy type or,
+    if that is unknown, on the values in the first batch. """
+    for (cls, arrow) in ((sqltypes.Boolean, pa.bool_),
+                         (sqltypes.Integer, pa.int64),
+                         (sqltypes.Numeric, pa.float64),
+                         (sqltypes.DateTime, lambda: pa.timestamp('us')),
+                         (sqltypes.Date, pa.date32)):
+        if isinstance(type_, cls):
+            return arrow()
+    if type_ is None or isinstance(type_, sqltypes.NullType):
+        try:
+            inferred = pa.array(list(values)).type
+            if inferred != pa.null():
+                return inferred
+        except (pa.ArrowException, TypeError, ValueError):
+            pass
+    return pa.string()
+
+def _fits(pa, type_, values):
+    """ Check if all values can be represented in the Arrow type. """
+    if type_ == pa.string():
+        return True
+    for (arrow, kind, exclude) in ((pa.bool_(), bool, ()),
+                                   (pa.int64(), (int, long), bool),
+                                   (pa.float64(), (int, long, float), bool),
+                                   (pa.date32(), date, datetime),
+                                   (pa.timestamp('us'), datetime, ())):
+        if type_ == arrow:
+            return all(v is None or (isinstance(v, kind) and \
+                       not isinstance(v, exclude)) for v in values)
+    return False
+
+def _array(pa, values, type_):
+    if type_ == pa.string():
+        values = [unicode(v) if v is not None and \
+                  not isinstance(v, unicode) else v for v in values]
+    return pa.array(values, type=type_)
+
+def _spool(pa, table, arrow_types):
+    """ Read all rows of the table and turn each column which holds 
+    values that do not fit its Arrow type into a string column. SQLite 
+    does not enforce column types, so this is only known once all rows 
+    have been seen; they are kept in a temporary file meanwhile. Returns 
+    an iterator over the batches of rows. """
+    spool = tempfile.TemporaryFile()
+    while True:
+        rows = map(tuple, islice(table, BATCH_SIZE))
+        if not len(rows):
+            break
+        for i, column in enumerate(zip(*rows)):
+            if not _fits(pa, arrow_types[i], column):
+                arrow_types[i] = pa.string()
+        cPickle.dump(rows, spool, cPickle.HIGHEST_PROTOCOL)
+    spool.seek(0)
+    def batches():
+        try:
+            while True:
+                yield cPickle.load(spool)
+        except EOFError:
+            spool.close()
+    return batches()
+
+def _generator(pa, table, keys, types, open_writer):
+    sink = _Sink()
+    table = iter(table)
+    rows = list(islice(table, BATCH_SIZE))
+    columns = zip(*rows) if len(rows) else [()] * len(keys)
+    arrow_types = [_arrow_type(pa, t, c) for (t, c) in zip(types, columns)]
+    table = chain(rows, table)
+    if all(t == pa.string() for t in arrow_types):
+        # text always fits, so rows are written as they arrive.
+        batches = iter(lambda: list(islice(table, BATCH_SIZE)), [])
+    else:
+        batches = _spool(pa, table, arrow_types)
+    schema = pa.schema([pa.field(k, t) for (k, t) in zip(keys, arrow_types)])
+    write, close = open_writer(pa, sink, schema)
+    for rows in batches:
+        arrays = [_array(pa, list(c), f.type) for (c, f) in \
+                  zip(zip(*rows), schema)]
+        write(pa.RecordBatch.from_arrays(arrays, keys))
+        yield sink.drain()
+    close()
+    yield sink.drain()
+
+def _columnar_table(table, keys, headers, types, mimetype, open_writer):
+    try:
+        import pyarrow as pa
+    except ImportError:
+        return Response('Arrow Exporter not installed.', status=501,
+                        mimetype='text/plain')
+    types = types or [None] * len(keys)
+    return Response(_generator(pa, table, keys, types, open_writer),
+                    mimetype=mimetype, direct_passthrough=True,
+                    headers=headers)
+
+def _arrow_writer(pa, sink, schema):
+    writer = pa.RecordBatchStreamWriter(sink, schema)
+    return writer.write_batch, writer.close
+
+def _parquet_writer(pa, sink, schema):
+    import pyarrow.parquet as pq
+    writer = pq.ParquetWriter(sink, schema)
+    def write(batch):
+        writer.write_table(pa.Table.from_batches([batch]))
+    return write, writer.close
+
+def arrow_table(table, keys, headers=None, types=None):
+    """ Write the table as an Arrow IPC stream, one record batch at a
+    time. """
+    return _columnar_table(table, keys, headers, types,
+            'application/vnd.apache.arrow.stream', _arrow_writer)
+
+def parquet_table(table, keys, headers=None, types=None):
+    """ Write the table as a Parquet file with one row group per batch
+    of rows. """
+    return _columnar_table(table, keys, headers, types,
+            'application/vnd.apache.parquet', _parquet_writer)
@@ -1,45 +1,51 @@
-from StringIO import StringIO
 from csv import DictReader, writer, DictWriter
 
 from flask import Response
-#from ilines import ilines
+from webstore.formats.chunked import chunk_size, FIRST_CHUNK_SIZE
+from webstore.formats.ilines import ilines, request_blocks
 
 def csv_request(request):
-    reader = DictReader(StringIO(request.data))
+    """ Read rows from the request body as it arrives, rather than 
+    loading it into memory in one piece. """
+    reader = DictReader(ilines(request_blocks(request)))
     for row in reader:
         yield row
 
-    # streaming disabled for now
-    #
-    # with streaming, if an incomplete csv file was sent (for example, 'test/file'),
-    # DictReader would go into an infinite loop waiting for the rest of the file,
-    # causing the webstore process to hang
-    #
-    # reader = DictReader(request.stream)
-    # for row in reader:
-    #     yield dict([(k, v.decode('utf-8') if v is not None else '') \
-    #             for k,v in row.items()])
-    #     if request.stream.is_exhausted:
-    #         break
-
-def _csv_line(keys, row):
-    sio = StringIO()
-    csv = writer(sio)
-    _row = []
-    for key in keys: 
-        v = row[key]
-        if isinstance(v, unicode):
-            v = v.encode('utf-8')
-        _row.append(v)
-    csv.writerow(_row)
-    return sio.getvalue()
+class _Buffer(object):
+    """ A file-like object collecting the lines written by a CSV writer 
+    until they are drained as one chunk. """
+
+    def __init__(self):
+        self.parts = []
+        self.length = 0
+
+    def write(self, data):
+        self.parts.append(data)
+        self.length += len(data)
+
+    def drain(self):
+        data = ''.join(self.parts)
+        self.parts, self.length = [], 0
+        return data
+
+def _encode(value):
+    return value.encode('utf-8') if isinstance(value, unicode) else value
+
+def _generator(table, keys, size):
+    # a single writer and buffer are used for the whole table.
+    buffer = _Buffer()
+    csv = writer(buffer)
+    csv.writerow(map(_encode, keys))
+    limit = min(FIRST_CHUNK_SIZE, size)
+    for row in table:
+        csv.writerow(map(_encode, row))
+        if buffer.length >= limit:
+            yield buffer.drain()
+            limit = size
+    yield buffer.drain()
 
 def csv_table(table, keys, headers=None):
-    def _generator():
-        yield _csv_line(keys, dict(zip(keys, keys)))
-        for row in table:
-            yield _csv_line(keys, row)
-    return Response(_generator(), mimetype='text/csv',
+    return Response(_generator(table, keys, chunk_size()), mimetype='text/csv',
                     direct_passthrough=True, headers=headers)
 
 def csv_message(message, state='error', url=None, code=200):
@@ -1,15 +1,81 @@
-from itertools import islice
+from datetime import date, datetime, time
+from decimal import Decimal
+try:
+    from json import dumps
+except ImportError:
+    from simplejson import dumps
+from itertools import chain
 
 from flask import Response
+from sqlalchemy import types as sqltypes
 
-def gviz_table(table, keys, headers=None):
-    try:
-        import gviz_api
-        description = dict([(k, ()) for k in keys])
-        data_table = gviz_api.DataTable(description)
-        data_table.LoadData(list(islice(table, 10000)))
-        return Response(data_table.ToJSon(), mimetype='text/plain',
-                headers=headers)
-    except ImportError:
-        return Response('GViz Exporter not installed.', status=501, mimetype='text/plain')
+from webstore.formats.chunked import chunked, chunk_size
+from webstore.formats.ft_json import TableEncoder
 
+# the order matters, as e.g. DateTime columns also hold dates and bools 
+# are ints.
+COLUMN_TYPES = [(sqltypes.Boolean, 'boolean'), (sqltypes.Integer, 'number'),
+                (sqltypes.Numeric, 'number'), (sqltypes.DateTime, 'datetime'),
+                (sqltypes.Date, 'date'), (sqltypes.Time, 'timeofday')]
+VALUE_TYPES = [(bool, 'boolean'), ((int, long, float), 'number'),
+               (datetime, 'datetime'), (date, 'date'), (time, 'timeofday')]
+
+def _gviz_type(type_, value):
+    """ Map a column to a DataTable type, based on its SQLAlchemy type
+    or, if that is unknown, on a sample value. """
+    for (cls, gviz) in COLUMN_TYPES:
+        if isinstance(type_, cls):
+            return gviz
+    if type_ is None or isinstance(type_, sqltypes.NullType):
+        for (cls, gviz) in VALUE_TYPES:
+            if isinstance(value, cls):
+                return gviz
+    return 'string'
+
+# the values each column type can hold (bools are ints, though).
+CELL_TYPES = {'boolean': bool, 'number': (int, long, float, Decimal),
+              'datetime': datetime, 'date': date, 'timeofday': time,
+              'string': basestring}
+
+def _cell(value, type_):
+    if value is None:
+        return 'null'
+    if type_ == 'string' and not isinstance(value, basestring):
+        value = unicode(value)
+    if not isinstance(value, CELL_TYPES[type_]) or (type_ != 'boolean' \
+            and isinstance(value, bool)):
+        # SQLite does not enforce column types, so e.g. a date column
+        # may hold text. Such values are only shown in their text form.
+        return '{"v": null, "f": %s}' % dumps(unicode(value))
+    if isinstance(value, datetime):
+        value = 'Date(%d,%d,%d,%d,%d,%d)' % (value.year, value.month - 1,
+                value.day, value.hour, value.minute, value.second)
+    elif isinstance(value, date):
+        value = 'Date(%d,%d,%d)' % (value.year, value.month - 1, value.day)
+    elif isinstance(value, time):
+        value = [value.hour, value.minute, value.second]
+    return '{"v": %s}' % dumps(value, cls=TableEncoder)
+
+def _generator(table, cols):
+    yield '{"cols": %s, "rows": [' % dumps(cols)
+    separator = ''
+    types = [c['type'] for c in cols]
+    for row in table:
+        yield separator + '{"c": [' + ', '.join(map(_cell, row, types)) \
+                + ']}'
+        separator = ', '
+    yield ']}'
+
+def gviz_table(table, keys, headers=None, types=None):
+    """ Write a Google Visualization DataTable as JSON, row by row. """
+    table = iter(table)
+    first = next(table, None)
+    sample = first if first is not None else [None] * len(keys)
+    types = types or [None] * len(keys)
+    cols = [{'id': k, 'label': k, 'type': _gviz_type(t, v)} for \
+            (k, t, v) in zip(keys, types, sample)]
+    if first is not None:
+        table = chain([first], table)
+    return Response(chunked(_generator(table, cols), chunk_size()),
+                    mimetype='text/plain', direct_passthrough=True, 
+                    headers=headers)
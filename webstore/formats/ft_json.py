@@ -1,16 +1,29 @@
+from datetime import date, datetime
 try:
-    from json import dumps, loads
+    from json import dumps, JSONEncoder
 except ImportError:
-    from simplejson import dumps, loads
+    from simplejson import dumps, JSONEncoder
 
 from flask import Response, g
 
+from webstore.formats.chunked import chunked, chunk_size
+from webstore.formats.ilines import request_blocks
+from webstore.formats.jsonstream import JSONStream
+
+class TableEncoder(JSONEncoder):
+    """ Also encode dates, such as those stored in DATE columns. """
+
+    def default(self, obj):
+        if isinstance(obj, (date, datetime)):
+            return obj.isoformat()
+        return JSONEncoder.default(self, obj)
+
 def json_request(request):
-    json = loads(request.data)
-    if not isinstance(json, (list, tuple)):
-        yield json
+    stream = JSONStream(request_blocks(request))
+    if stream.peek() != '[':
+        yield stream.value()
     else:
-        for row in json:
+        for row in stream.items():
             yield row
 
 def _generator(table, callback, keys, headers):
@@ -20,25 +33,18 @@ def _generator(table, callback, keys, headers):
     count = headers.get('X-Count', 'null')
     yield '"count": %s, ' % count
     yield '"data": ['  
-    iter = table.__iter__()
-    has_next, first = True, True
-    while has_next:
-        try:
-            row = iter.next()
-        except StopIteration:
-            has_next = False
-        if has_next:
-            if not first: 
-                yield ', '
-            yield dumps(row)
-        first = False
+    separator = ''
+    for row in table:
+        yield separator + dumps(dict(zip(keys, row)), cls=TableEncoder)
+        separator = ', '
     yield ']'
     yield '})' if callback else '}'
 
 def json_table(table, keys, headers=None):
     headers = headers or {}
     callback = str(g.callback) if g.callback else None
-    return Response(_generator(table, callback, keys, headers), mimetype='application/json',
+    return Response(chunked(_generator(table, callback, keys, headers), 
+                            chunk_size()), mimetype='application/json',
                     direct_passthrough=True, headers=headers)
 
 def json_message(message, state='error', url=None, code=200):
@@ -1,38 +1,50 @@
 try:
-    from json import dumps, loads
+    from json import dumps
 except ImportError:
-    from simplejson import dumps, loads
+    from simplejson import dumps
 
 from flask import Response, g
 
+from webstore.formats.ft_json import TableEncoder
+from webstore.formats.chunked import chunked, chunk_size
+from webstore.formats.ilines import request_blocks
+from webstore.formats.jsonstream import JSONStream
+
 def jsontuples_request(request):
-    json = loads(request.data)
-    keys = json.get('keys', [])
-    for row in json.get('data', []):
-        yield dict(zip(keys, row))
+    stream = JSONStream(request_blocks(request))
+    keys, data = None, []
+    for member in stream.members():
+        if member == 'keys':
+            keys = stream.value()
+        elif member == 'data' and keys is not None and stream.peek() == '[':
+            for row in stream.items():
+                yield dict(zip(keys, row))
+        elif member == 'data' and stream.peek() == '[':
+            # rows sent before their keys need to be held back, but they
+            # are still decoded one at a time.
+            data = list(stream.items())
+        elif member == 'data':
+            data = stream.value()
+        else:
+            stream.value()
+    for row in data:
+        yield dict(zip(keys or [], row))
 
 def _generator(table, callback, keys):
     if callback:
         yield callback + '('
     yield '{"keys": %s, "data": [' % dumps(keys)
-    iter = table.__iter__()
-    has_next, first = True, True
-    while has_next:
-        try:
-            row = iter.next()
-        except StopIteration:
-            has_next = False
-        if has_next:
-            if not first: 
-                yield ','
-            yield dumps([row[k] for k in keys])
-        first = False
+    separator = ''
+    for row in table:
+        yield separator + dumps(row, cls=TableEncoder)
+        separator = ','
     yield ']})' if callback else ']}'
 
 def jsontuples_table(table, keys, headers=None):
     callback = str(g.callback) if g.callback else None
-    return Response(_generator(table, callback, keys), mimetype='application/json',
-                    direct_passthrough=True, headers=headers)
+    return Response(chunked(_generator(table, callback, keys), chunk_size()),
+                    mimetype='application/json', direct_passthrough=True, 
+                    headers=headers)
 
 def jsontuples_message(message, state='error', url=None, code=200):
     keys, values = ['message', 'state'], [message, state]
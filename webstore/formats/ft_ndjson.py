@@ -0,0 +1,35 @@
+try:
+    from json import dumps, loads
+except ImportError:
+    from simplejson import dumps, loads
+
+from flask import Response
+
+from webstore.formats.ft_json import TableEncoder
+from webstore.formats.chunked import chunked, chunk_size
+from webstore.formats.ilines import ilines, request_blocks
+
+def ndjson_request(request):
+    """ Read one JSON object per line, skipping blank lines. """
+    for line in ilines(request_blocks(request)):
+        if len(line.strip()):
+            yield loads(line)
+
+def _generator(table, keys):
+    for row in table:
+        yield dumps(dict(zip(keys, row)), cls=TableEncoder) + '\n'
+
+def ndjson_table(table, keys, headers=None):
+    return Response(chunked(_generator(table, keys), chunk_size()), 
+                    mimetype='application/x-ndjson',
+                    direct_passthrough=True, headers=headers)
+
+def ndjson_message(message, state='error', url=None, code=200):
+    obj = {'message': message, 'state': state}
+    if url is not None:
+        obj['url'] = url
+    response = Response(dumps(obj) + '\n', status=code, 
+                        mimetype='application/x-ndjson')
+    if url is not None:
+        response.headers['Location'] = url
+    return response
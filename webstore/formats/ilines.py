@@ -13,13 +13,15 @@ def ilines(source_iterable):
                 pos = 1
             else:
                 tail = ''
+                pos = 0
         else:
             pos = 0
         try:
             while True: # While we are finding LF.
                 npos = block.index('\012', pos) + 1
                 try:
-                    rend = npos - 2
+                    # don't let a LF at pos wrap around to the block end
+                    rend = max(npos - 2, pos)
                     rpos = block.index('\015', pos, rend)
                     if pos:
                         yield block[pos : rpos] + '\n'
@@ -60,6 +62,30 @@ def ilines(source_iterable):
             tail = block[pos:]
         else:
             tail += block
-    if tail:
+    if tail.endswith('\015'):
+        yield tail[:-1] + '\012'
+    elif tail:
         yield tail
 
+
+# Size of the blocks in which request bodies are read.
+BLOCK_SIZE = 64 * 1024
+
+def request_blocks(request, size=BLOCK_SIZE):
+    """ Yield the body of a request in blocks of at most ``size`` bytes 
+    without reading past its end, which is given by the Content-Length or, 
+    for chunked requests, by the end of the input. If the client goes away
+    early, ClientDisconnected (a 400 Bad Request) is raised, so that a 
+    truncated upload is not mistaken for a complete one. """
+    if request.content_length is not None:
+        stream = request.stream
+    elif request.environ.get('wsgi.input_terminated') or \
+            request.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+        stream = request.environ['wsgi.input']
+    else:
+        return
+    while True:
+        block = stream.read(size)
+        if not block:
+            break
+        yield block
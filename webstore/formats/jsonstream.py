@@ -0,0 +1,103 @@
+try:
+    from json import JSONDecoder
+except ImportError:
+    from simplejson import JSONDecoder
+
+WHITESPACE = ' \t\n\r'
+NUMBER = '0123456789+-.eE'
+
+class JSONStream(object):
+    """ Decode a JSON document piece by piece as it arrives in blocks,
+    so that the elements of a large array can be handled one at a time
+    instead of parsing the whole document into memory first. Malformed
+    or truncated documents raise a ValueError, like ``loads`` does. """
+
+    def __init__(self, blocks):
+        self.blocks = iter(blocks)
+        self.decoder = JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        self.done = False
+
+    def _fill(self, size=1):
+        """ Append at least ``size`` more bytes (or what is left of the 
+        input) to the buffer, dropping anything which has already been 
+        decoded. Returns False at the end of input. """
+        blocks, length = [], 0
+        for block in self.blocks:
+            blocks.append(block)
+            length += len(block)
+            if length >= max(size, 1):
+                break
+        else:
+            self.done = True
+        if not length:
+            return False
+        self.buffer = self.buffer[self.pos:] + ''.join(blocks)
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """ Return the next non-whitespace character, or an empty string
+        at the end of input. """
+        while True:
+            while self.pos < len(self.buffer) and \
+                    self.buffer[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer) or not self._fill():
+                return self.buffer[self.pos:self.pos + 1]
+
+    def expect(self, chars):
+        char = self.peek()
+        if not len(char) or not char in chars:
+            raise ValueError("Expected %s at %s" % (' or '.join(chars),
+                                                    repr(char or 'end')))
+        self.pos += 1
+        return char
+
+    def value(self):
+        """ Decode the next complete value. """
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # a number at the end of the buffer may continue in the
+                # next block.
+                if self.done or (end < len(self.buffer) and 
+                                 not self.buffer[end] in NUMBER):
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.done:
+                    raise
+            # decoding starts over from the beginning of the value, so 
+            # read as much again before the next attempt.
+            self._fill(len(self.buffer) - self.pos)
+
+    def items(self):
+        """ Iterate over the values in an array. """
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.expect(',]') == ']':
+                return
+
+    def members(self):
+        """ Iterate over the keys of an object. The value of each member
+        must be consumed (e.g. through ``value`` or ``items``) before the
+        next key is requested. """
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            if not isinstance(key, basestring):
+                raise ValueError("Expected a member name: %r" % key)
+            self.expect(':')
+            yield key
+            if self.expect(',}') == '}':
+                return
@@ -1,24 +1,54 @@
 import pkg_resources
 import logging
+from base64 import urlsafe_b64encode, urlsafe_b64decode
 from datetime import timedelta
+try:
+    from json import dumps, loads
+except ImportError:
+    from simplejson import dumps, loads
 from functools import update_wrapper
 
 from flask import make_response, request, current_app
 from werkzeug.exceptions import HTTPException
 
 from webstore.formats import render_message
+from webstore.formats.ft_json import TableEncoder
 
 log = logging.getLogger(__name__)
 
-def result_proxy_iterator(rp):
-    """ SQLAlchemy ResultProxies are not iterable to get a 
-    list of dictionaries. This is to wrap them. """
-    keys = rp.keys()
+def result_proxy_iterator(rp, size=1000):
+    """ Iterate over the rows of a SQLAlchemy ResultProxy as plain
+    tuples, in the order of ``rp.keys()``. Rows are fetched in batches 
+    of ``size``. """
     while True:
-        row = rp.fetchone()
-        if row is None:
+        rows = rp.fetchmany(size)
+        if not len(rows):
             break
-        yield dict(zip(keys, row))
+        for row in rows:
+            yield tuple(row)
+
+def result_proxy_types(rp):
+    """ Get the SQLAlchemy types of the columns of a ResultProxy as far 
+    as they are known from the query, None for all others. """
+    result_map = getattr(rp.context, 'result_map', None) or {}
+    return [result_map.get(k.lower(), (None, None, None))[2] \
+            for k in rp.keys()]
+
+def encode_cursor(values):
+    """ Turn a list of values into an opaque, URL-safe token. """
+    return urlsafe_b64encode(dumps(values, cls=TableEncoder)).rstrip('=')
+
+def decode_cursor(cursor):
+    """ Reverse ``encode_cursor``, raises ValueError if the cursor is 
+    not valid. """
+    try:
+        cursor = str(cursor)
+        values = loads(urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (TypeError, UnicodeError), e:
+        raise ValueError(e)
+    if not isinstance(values, list):
+        raise ValueError(cursor)
+    return values
 
 class WebstoreException(HTTPException):
     """ Cancel abortion of the current task and return with
@@ -1,118 +1,123 @@
-# http://code.google.com/p/pythonxy/source/browse/src/python/pytables/PLATLIB/tables/misc/lrucache.py?spec=svn.xy-27.d2ca019c1b156e5929b738c38644f6816dff377b&repo=xy-27&r=d2ca019c1b156e5929b738c38644f6816dff377b
-# lrucache.py -- a simple LRU (Least-Recently-Used) cache class
-
-# Copyright 2004 Evan Prodromou <evan@bad.dynu.ca>
-# Licensed under the Academic Free License 2.1
-
-# Modified to use monotonically increasing integer values as access times
-# by Ivan Vilata i Balaguer <ivan@selidor.net>.
-
-# arch-tag: LRU cache main module
+""" A least-recently-used cache with expiring entries. """
 import time
-from heapq import heappush, heappop, heapify
+import threading
+from collections import OrderedDict
 
 
 class CacheKeyError(KeyError):
     pass
 
 class LRUTimeoutCache(object):
-
-    class __Node(object):
-
-        def __init__(self, key, obj, timestamp):
-            object.__init__(self)
-            self.key = key
-            self.obj = obj
-            self.atime = timestamp
-
-        def __cmp__(self, other):
-            return cmp(self.atime, other.atime)
-
-        def __repr__(self):
-            return "<%s %s => %s (accessed at %s)>" % \
-                   (self.__class__, self.key, self.obj, self.atime)
-
-    def __init__(self, size, timeout=60*15):
+    """ A thread-safe mapping which holds at most ``size`` entries,
+    evicting the least recently used one to make room for new ones.
+    Entries expire ``timeout`` seconds after they have been set; entries
+    with a false value (e.g. a refused request) can be given a different
+    lifetime through ``negative_timeout``. Expired entries are dropped
+    when they are next looked up. All operations take constant time.
+    """
+
+    def __init__(self, size, timeout=60*15, negative_timeout=None):
         if size <= 0:
             raise ValueError, size
-        elif type(size) is not type(0):
+        elif type(size) not in (int, long):
             raise TypeError, size
         object.__init__(self)
-        self.__heap = []
-        self.__dict = {}
+        # key -> (value, expiry time), in order of last access.
+        self.__entries = OrderedDict()
+        self.__lock = threading.RLock()
         self.timeout = timeout
+        self.negative_timeout = negative_timeout
+        self.hits = self.misses = self.evictions = 0
         self.size = size
 
     def __len__(self):
-        return len(self.__heap)
+        return len(self.__entries)
+
+    def __lookup(self, key):
+        # return the live entry for key, moving it to the most recently
+        # used position, or None.
+        entry = self.__entries.pop(key, None)
+        if entry is None or entry[1] < time.time():
+            return None
+        self.__entries[key] = entry
+        return entry
 
     def __contains__(self, key):
-        if self.__dict.has_key(key):
-            if self.__dict[key].atime >= time.time() - self.timeout:
-                return True
-            else:
-                del self.__dict[key]
-        return False
+        with self.__lock:
+            return self.__lookup(key) is not None
+
+    def set(self, key, obj, timeout=None):
+        """ Store ``obj``, expiring after ``timeout`` seconds instead of
+        the default for the cache. """
+        if timeout is None:
+            timeout = self.timeout
+            if not obj and self.negative_timeout is not None:
+                timeout = self.negative_timeout
+        with self.__lock:
+            self.__entries.pop(key, None)
+            while len(self.__entries) >= self.size:
+                self.__entries.popitem(last=False)
+                self.evictions += 1
+            self.__entries[key] = (obj, time.time() + timeout)
 
     def __setitem__(self, key, obj):
-        if key in self:
-            node = self.__dict[key]
-            node.obj = obj
-            node.atime = time.time()
-            heapify(self.__heap)
-        else:
-            while len(self.__heap) >= self.size:
-                lru = heappop(self.__heap)
-                del self.__dict[lru.key]
-            node = self.__Node(key, obj, time.time())
-            self.__dict[key] = node
-            heappush(self.__heap, node)
+        self.set(key, obj)
+
+    def get(self, key, default=None):
+        """ Return the value for ``key``, or ``default`` if it is not
+        cached or has expired. """
+        with self.__lock:
+            entry = self.__lookup(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return entry[0]
 
     def __getitem__(self, key):
-        if not key in self:
-            raise CacheKeyError(key)
-        else:
-            node = self.__dict[key]
-            node.atime = time.time()
-            heapify(self.__heap)
-            return node.obj
+        with self.__lock:
+            entry = self.__lookup(key)
+            if entry is None:
+                self.misses += 1
+                raise CacheKeyError(key)
+            self.hits += 1
+            return entry[0]
+
+    def pop(self, key):
+        with self.__lock:
+            entry = self.__entries.pop(key, None)
+            if entry is None or entry[1] < time.time():
+                raise CacheKeyError(key)
+            return entry[0]
 
     def __delitem__(self, key):
-        if key in self: 
-            raise CacheKeyError(key)
-        else:
-            node = self.__dict[key]
-            del self.__dict[key]
-            self.__heap.remove(node)
-            heapify(self.__heap)
-            return node.obj
+        self.pop(key)
 
-    def pop(self, key):
-        if not key in self:
-            raise CacheKeyError(key)
-        else:
-            node = self.__dict[key]
-            del self.__dict[key]
-            self.__heap.remove(node)
-            heapify(self.__heap)
-            return node.obj
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+
+    def stats(self):
+        """ Report on the use of the cache. """
+        with self.__lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions,
+                    'entries': len(self.__entries), 'size': self.size}
 
     def __iter__(self):
-        copy = self.__heap[:]
-        while len(copy) > 0:
-            node = heappop(copy)
-            yield node.key
-        raise StopIteration
+        """ Iterate over the keys, least recently used first. """
+        with self.__lock:
+            keys = list(self.__entries)
+        return iter(keys)
 
     def __setattr__(self, name, value):
         object.__setattr__(self, name, value)
         if name == 'size':
-            while len(self.__heap) > value:
-                lru = heappop(self.__heap)
-                del self.__dict[lru.key]
+            with self.__lock:
+                while len(self.__entries) > value:
+                    self.__entries.popitem(last=False)
+                    self.evictions += 1
 
     def __repr__(self):
-        return "<%s (%d elements)>" % (str(self.__class__), len(self.__heap))
-
-
-
+        return "<%s (%d elements)>" % (str(self.__class__),
+                                       len(self.__entries))
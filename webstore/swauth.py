@@ -23,7 +23,9 @@ from webstore.lru import LRUTimeoutCache
 from webstore.helpers import WebstoreException
 
 log = logging.getLogger(__name__)
-cache = LRUTimeoutCache(10000)
+# refusals are cached for a shorter time, so that newly granted access
+# is picked up soon.
+cache = LRUTimeoutCache(10000, negative_timeout=60)
 
 def sw_auth(request):
     """ Authenticate an incoming request. """
@@ -42,8 +44,9 @@ def sw_has(user, database, action):
     if sw_scrapername == database:
         return True
     cache_key = (sw_scrapername, database)
-    if cache_key in cache:
-        return cache[cache_key]
+    result = cache.get(cache_key)
+    if result is not None:
+        return result
     url = urljoin(current_app.config['SW_URL'], 'webstoreauth')
     query = '?scrapername=%s&attachtoname=%s' % (
             urllib.quote(sw_scrapername or ''),
@@ -1,25 +1,39 @@
 import os
+import re
+import time
+import calendar
 import logging 
+from hashlib import sha1
 
 from flask import Blueprint, current_app, send_from_directory
 from flask import request, url_for, g, send_file
+from werkzeug.wsgi import ClosingIterator
 
 from sqlalchemy.sql.expression import asc, desc
-from sqlalchemy.sql.expression import select
-from sqlalchemy import func
+from sqlalchemy.sql.expression import select, and_
 from sqlalchemy.exc import OperationalError, DatabaseError, \
         StatementError
 
 from webstore.formats import render_table, render_message
-from webstore.formats import read_request, response_format
-from webstore.formats import SQLITE
+from webstore.formats import read_request, request_format, response_format
+from webstore.formats import TEXT_FORMATS
+from webstore.formats import SQLITE, compress
 from webstore.helpers import WebstoreException
 from webstore.helpers import crossdomain, result_proxy_iterator
+from webstore.helpers import result_proxy_types
+from webstore.helpers import encode_cursor, decode_cursor
 from webstore.validation import NamingException
 from webstore.security import require, has
 from webstore.database import SQLiteDatabaseHandlerFactory, UserNotFound
+from webstore.database import ID_COLUMN
 
 log = logging.getLogger(__name__)
+
+# SQL functions whose results change even if the database does not.
+VOLATILE = re.compile(r"\b(random|randomblob|changes|total_changes|"
+    r"last_insert_rowid)\s*\(|\b(date|time|datetime|julianday|unixepoch)"
+    r"\s*\(\s*\)|'now'|\bcurrent_(date|time|timestamp)\b", re.I)
+
 store = Blueprint('webstore', __name__)
 db_factory = SQLiteDatabaseHandlerFactory(current_app)
 
@@ -31,18 +45,158 @@ def jsonp_callback_register():
     g.callback = request.args.get('_callback')
 
 
+def _closing(resource):
+    """ Make sure ``resource`` (e.g. a connection or a table handler) 
+    is closed once the response to the current request has been sent. 
+    """
+    if getattr(g, 'closing', None) is None:
+        g.closing = []
+    g.closing.append(resource)
+    return resource
 
-def _get_table(user, database, table, format):
-    """ Locate a named table or raise a 404. """
+def _close_all(resources):
+    for resource in resources:
+        try:
+            resource.close()
+        except Exception, e:
+            log.exception(e)
+
+@store.after_app_request
+def close_after_response(response):
+    # Table data is streamed, so connections can only be released once
+    # the response body has been sent, not when the request context
+    # is torn down.
+    resources, g.closing = getattr(g, 'closing', None), None
+    if resources:
+        close = lambda: _close_all(resources)
+        if response.direct_passthrough:
+            response.response = ClosingIterator(response.response, close)
+        else:
+            response.call_on_close(close)
+    return response
+
+@store.after_app_request
+def set_validators(response):
+    validators = getattr(g, 'validators', None)
+    if validators is not None and response.status_code in (200, 304):
+        etag, modified = validators
+        response.headers['ETag'] = etag
+        if modified is not None:
+            response.last_modified = modified
+    return response
+
+@store.teardown_app_request
+def close_on_error(exc=None):
+    # no response was generated, so nobody else will close these.
+    resources, g.closing = getattr(g, 'closing', None), None
+    if resources:
+        _close_all(resources)
+
+def _get_database(user, database, format):
     try:
-        db = db_factory.create(user, database)
+        return db_factory.create(user, database)
     except NamingException, ne:
         raise WebstoreException('Invalid DB name: %s' % ne.field,
                 format, state='error', code=400)
+
+def _query_failed(error, format):
+    """ Turn an error raised by a query into a response: 503, to be
+    retried, if the database was locked by a writer, 400 otherwise. """
+    if 'locked' in unicode(error.message):
+        exc = WebstoreException('Database is busy: %s' % error.message,
+                                format, state='error', code=503)
+        exc.response.headers['Retry-After'] = '1'
+        return exc
+    return WebstoreException('Invalid query: %s' % error.message,
+                             format, state='error', code=400)
+
+def _not_modified(db, format):
+    """ Derive validators (an ETag and the time of the last change)
+    for the response to the current request from the version of the 
+    database. If the client's copy is still current, a 304 response is
+    returned, before any query is run. """
+    version = db.version()
+    # kept for the result cache, so as not to look the version up twice.
+    g.version = (db, version)
+    if version is None:
+        return None
+    token, modified = version
+    key = repr((token, request.path, response_format(request, format),
+                sorted(request.args.items(multi=True))))
+    etag = sha1(key).hexdigest()
+    # weak, as the same data may be sent with different encodings.
+    g.validators = ('W/"%s"' % etag, modified)
+    if 'If-None-Match' in request.headers:
+        current = request.if_none_match.contains_weak(etag)
+    else:
+        # dates only have a resolution of seconds, so a change in the 
+        # current second may be followed by another one unnoticed.
+        since = request.if_modified_since
+        current = since is not None and modified is not None and \
+                modified.replace(microsecond=0) <= since and \
+                int(time.time()) > calendar.timegm(modified.timetuple())
+    if current:
+        return current_app.response_class(status=304)
+
+def _tee(pieces, charset, limit, store):
+    # pass the body through, keeping a copy for ``store`` unless it
+    # grows beyond ``limit`` bytes or is not sent completely.
+    parts, size = [], 0
+    for piece in pieces:
+        if isinstance(piece, unicode):
+            piece = piece.encode(charset)
+        if parts is not None:
+            size += len(piece)
+            if size > limit:
+                parts = None
+            else:
+                parts.append(piece)
+        yield piece
+    if parts is not None:
+        store(''.join(parts))
+
+def _cached_table(db, key, format, render):
+    """ Serve a table from the result cache, if the database has not 
+    been changed since it was stored there. Otherwise, ``render`` is 
+    called to produce an uncompressed response, and a copy of its body
+    is cached as it is sent. ``key`` is called to build the cache key
+    only if the cache is enabled. """
+    cache = db_factory.results
+    if cache is None:
+        return compress(request, render())
+    handler, version = getattr(g, 'version', (None, None))
+    if handler is not db:
+        version = db.version()
+    if version is None:
+        return compress(request, render())
+    key = (db.path, response_format(request, format)) + key()
+    cached = cache.get(key, version[0])
+    if cached is not None:
+        status, headers, body = cached
+        response = current_app.response_class(body, status=status,
+                                              headers=headers)
+        response.headers['X-Cache'] = 'HIT'
+        return compress(request, response)
+    response = render()
+    if response.status_code == 200:
+        headers = [(k, v) for (k, v) in response.headers \
+                   if k.lower() != 'content-length']
+        store = lambda body: cache.put(key, version[0], 
+                (response.status, headers, body), len(body))
+        body = response.response
+        response.response = ClosingIterator(_tee(body, response.charset,
+            cache.entry_limit, store), getattr(body, 'close', None))
+        response.direct_passthrough = True
+    response.headers['X-Cache'] = 'MISS'
+    return compress(request, response)
+
+def _get_table(user, database, table, format):
+    """ Locate a named table or raise a 404. """
+    db = _get_database(user, database, format)
     if not table in db:
         raise WebstoreException('No such table: %s' % table,
                 format, state='error', code=404)
-    return db[table]
+    return _closing(db[table])
 
 def _request_query(_table, _params, format):
     """ From a set of query parameters, apply those that
@@ -78,6 +232,24 @@ def _request_query(_table, _params, format):
     args = {'limit': limit, 'offset': offset, 'order_by': sorts}
     return params, args
 
+def _cursor_keys(_table, format):
+    """ Determine the columns by which a keyset cursor walks the table:
+    the requested sort order, followed by the row ID to break ties. 
+    Returns a list of (column, descending) tuples. """
+    keys = []
+    for sort in request.args.getlist('_sort'):
+        order, column = sort.split(':', 1)
+        if not column in _table.table.columns:
+            raise WebstoreException('Invalid sort column: %s' % column,
+                format, state='error', code=400)
+        keys.append((_table.table.c[column], order.lower() == 'desc'))
+    if not ID_COLUMN in _table.table.columns:
+        raise WebstoreException('Table has no %s column' % ID_COLUMN,
+            format, state='error', code=400)
+    if not ID_COLUMN in [c.name for (c, d) in keys]:
+        keys.append((_table.table.c[ID_COLUMN], False))
+    return keys
+
 @store.route('/<user>.<format>', methods=['GET', 'OPTIONS'])
 @store.route('/<user>', methods=['GET', 'OPTIONS'])
 @crossdomain(origin='*')
@@ -142,12 +314,22 @@ def index(user, database, format=None):
         if not os.path.isfile(db.engine.engine.url.database):
             return WebstoreException('No such database: %s' % database,
                                 'json', state='error', code=404)
+        not_modified = _not_modified(db, format)
+        if not_modified is not None:
+            return not_modified
         log.debug("Streaming out DB: %s" % db.engine.engine.url.database)
-        return send_file(db.engine.engine.url.database,
-                         mimetype=SQLITE)
+        db.checkpoint()
+        response = send_file(db.engine.engine.url.database,
+                             mimetype=SQLITE, add_etags=False)
+        if current_app.config.get('COMPRESS_SQLITE_DOWNLOAD'):
+            response = compress(request, response)
+        return response
 
+    not_modified = _not_modified(db, format)
+    if not_modified is not None:
+        return not_modified
     tables = []
-    for table in db.engine.table_names():
+    for table in db.table_names():
         url = url_for('webstore.read', user=user, database=database, table=table)
         tables.append({'name': table, 'url': url})
     return render_table(request, tables, ['name', 'url', 'columns'], format)
@@ -178,7 +360,7 @@ def sql(user, database, format=None):
         raise WebstoreException('Invalid DB name: %s' % ne.field,
                 format, state='error', code=400)
     try:
-        connection = db.engine.connect()
+        connection = _closing(db.connect())
         for attach in attaches:
             attach_user = attach.get('user', user)
             attach_db = attach['database']
@@ -188,9 +370,21 @@ def sql(user, database, format=None):
         params_dict = params if isinstance(params, dict) else {}
         params_list = [] if isinstance(params, dict) or not params else params
         log.debug("Query: %s (params: %s)" % (query, params))
-        results = connection.execute(query, *params_list, **params_dict)
-        return render_table(request, result_proxy_iterator(results), 
-                            results.keys(), format)
+        def render():
+            results = connection.execute(query, *params_list, 
+                                         **params_dict)
+            return render_table(request, result_proxy_iterator(results), 
+                                results.keys(), format, 
+                                types=result_proxy_types(results),
+                                compression=False)
+        # only plain SELECTs on a single database can be cached, as 
+        # changes to attached databases are not tracked.
+        if not current_app.config.get('RESULT_CACHE_SQL') or \
+                len(attaches) or VOLATILE.search(query) or \
+                not query.lstrip()[:6].upper() == 'SELECT':
+            return compress(request, render())
+        key = lambda: (query.strip(), repr(params), g.callback)
+        return _cached_table(db, key, format, render)
     except NamingException, ne:
         raise WebstoreException('Invalid attach DB name: %s' % ne.field,
                 format, state='error', code=400)
@@ -223,7 +417,7 @@ def upsert(user, database, table, format=None):
         raise WebstoreException('Invalid DB name: %s' % ne.field,
                 format, state='error', code=400)
     try:
-        _table = db[table]
+        _table = _closing(db[table])
     except NamingException, ne:
         raise WebstoreException('Invalid table name: %s' % ne.field,
                                 format, state='error', code=400)
@@ -231,15 +425,20 @@ def upsert(user, database, table, format=None):
     if len(unique):
         require(user, database, 'delete', format)
     reader = read_request(request, format)
-    new_count = 0
+    rows = (row for row in reader if len(row.keys()))
+    batch = dict(batch_size=current_app.config.get('INGEST_BATCH_SIZE', 1000),
+                 lookahead=current_app.config.get('INGEST_LOOKAHEAD'))
+    if request_format(request, format) in TEXT_FORMATS:
+        batch['type_sample'] = current_app.config.get('TYPE_INFERENCE_SAMPLE', 0)
+    else:
+        # typed input has the types of existing columns enforced.
+        batch['strict'] = True
     try:
-        for row in reader:
-            if not len(row.keys()):
-                continue
-            if not _table.update_row(unique, row):
-                _table.add_row(row)
-            new_count += 1
-    except StatementError, se:
+        if len(unique):
+            new_count = _table.upsert_rows(unique, rows, **batch)
+        else:
+            new_count = _table.add_rows(rows, **batch)
+    except (StatementError, ValueError), se:
         raise WebstoreException(unicode(se), format, state='error', 
                                 code=400)
     except NamingException, ne:
@@ -259,31 +458,69 @@ def read(user, database, table, format=None):
     params, select_args = _request_query(_table, request.args,
                                          format)
     # pop count here so as not to raise invalid filter error
-    count = params.pop('_count', '') 
+    count = params.pop('_count', '').lower() in ['1', 'true']
+    after = params.pop('_after', None)
+    not_modified = _not_modified(_table.database, format)
+    if not_modified is not None:
+        return not_modified
     try:
         clause = _table.args_to_clause(params)
     except KeyError, ke:
         raise WebstoreException('Invalid filter: %s' % ke,
                 format, state='error', code=400)
-    try:
-        statement = _table.table.select(clause, **select_args)
-        log.debug("Read: %s" % statement)
-        results = _table.bind.execute(statement)
+    # counts cover all pages, not just the rows after the cursor.
+    filters = clause
+    if after is not None:
+        # keyset pagination: continue after the last row of the previous
+        # page instead of skipping over an offset.
+        if select_args['offset']:
+            raise WebstoreException('Cannot combine _after and _offset',
+                format, state='error', code=400)
+        keys = _cursor_keys(_table, format)
+        select_args['order_by'] = [desc(c) if d else asc(c) for (c, d) in keys]
+        if len(after):
+            try:
+                values = decode_cursor(after)
+                if len(values) != len(keys):
+                    raise ValueError(after)
+            except ValueError:
+                raise WebstoreException('Invalid cursor: %s' % after,
+                    format, state='error', code=400)
+            clause = and_(clause, _table.keyset_clause(keys, values))
+    statement = _table.table.select(clause, **select_args)
 
-        # produce a count 
-        # TODO: make this optional?
-        headers = {}
-        if count.lower() in ['1', 'true']:
-            count_statement = select([func.count()], clause, _table.table)
-            count = _table.bind.execute(count_statement).fetchone()[0]
-            log.debug("Results: %s" % count)
-            headers['X-Count'] = count
+    def render():
+        try:
+            log.debug("Read: %s" % statement)
+            results = _table.bind.execute(statement)
+            rows = result_proxy_iterator(results)
 
-    except OperationalError, oe:
-        raise WebstoreException('Invalid query: %s' % oe.message,
-            format, state='error', code=400)
-    return render_table(request, result_proxy_iterator(results), 
-                        results.keys(), format, headers=headers)
+            headers = {}
+            if after is not None and select_args['limit']:
+                rows = list(rows)
+                if len(rows) == select_args['limit']:
+                    last = dict(zip(results.keys(), rows[-1]))
+                    headers['X-Next-Cursor'] = encode_cursor(
+                        [last[c.name] for (c, d) in keys])
+
+            # produce a count 
+            # TODO: make this optional?
+            if count:
+                headers['X-Count'] = _table.count(filters)
+                log.debug("Results: %s" % headers['X-Count'])
+
+        except (OperationalError, StatementError), oe:
+            raise _query_failed(oe, format)
+        return render_table(request, rows, results.keys(), format, 
+                            headers=headers, 
+                            types=result_proxy_types(results),
+                            compression=False)
+
+    def key():
+        compiled = statement.compile()
+        return (unicode(compiled), tuple(sorted(compiled.params.items())),
+                count, after is not None, g.callback)
+    return _cached_table(_table.database, key, format, render)
 
 @store.route('/<user>/<database>/<table>/row/<row>.<format>', methods=['GET', 'OPTIONS'])
 @store.route('/<user>/<database>/<table>/row/<row>', methods=['GET', 'OPTIONS'])
@@ -301,23 +538,41 @@ def row(user, database, table, row, format=None):
             'Starting at offset 1 to allow header row',
             format, state='error', code=400)
     params, select_args = _request_query(_table, request.args, format)
-    select_args['limit'] = 1
-    select_args['offset'] = row-1
+    not_modified = _not_modified(_table.database, format)
+    if not_modified is not None:
+        return not_modified
     try:
-        statement = _table.table.select('', **select_args)
+        ordinal = None
+        if not select_args['order_by'] and ID_COLUMN in _table.table.columns:
+            # without an up to date ordinal index (it is built before 
+            # the next write), fall back to skipping over the rows.
+            ordinal = _table.ordinal_clause(row)
+        if ordinal is None:
+            select_args['limit'] = 1
+            select_args['offset'] = row-1
+            if ID_COLUMN in _table.table.columns and \
+                    not select_args['order_by']:
+                select_args['order_by'].append(_table.table.c[ID_COLUMN])
+            statement = _table.table.select('', **select_args)
+        else:
+            statement = _table.table.select(ordinal)
         log.debug("Read row: %s" % statement)
         results = _table.bind.execute(statement)
     except OperationalError, oe:
-        raise WebstoreException('Invalid query: %s' % oe.message,
-            format, state='error', code=400)
+        raise _query_failed(oe, format)
     return render_table(request, result_proxy_iterator(results), 
-                        results.keys(), format)
+                        results.keys(), format, 
+                        types=result_proxy_types(results))
 
 @store.route('/<user>/<database>/<table>/schema.<format>', methods=['GET', 'OPTIONS'])
 @store.route('/<user>/<database>/<table>/schema', methods=['GET', 'OPTIONS'])
 @crossdomain(origin='*')
 def schema(user, database, table, format=None):
     require(user, database, 'read', format)
+    not_modified = _not_modified(_get_database(user, database, format), 
+                                 format)
+    if not_modified is not None:
+        return not_modified
     _table = _get_table(user, database, table, format)
     schema = []
     for column in _table.table.columns:
@@ -339,22 +594,29 @@ def distinct(user, database, table, column, format=None):
     if not column in _table.table.columns:
         raise WebstoreException('No such column: %s' % column,
                 format, state='error', code=404)
+    # the frequencies are set up on first use, which is a write and has
+    # to happen before the version of the database is taken.
+    try:
+        frequencies = _table.frequencies(column)
+    except OperationalError, oe:
+        raise _query_failed(oe, format)
+    not_modified = _not_modified(_table.database, format)
+    if not_modified is not None:
+        return not_modified
     params, select_args = _request_query(_table, request.args,
                                          format)
-    select_args['distinct'] = True
     if not len(select_args['order_by']):
         select_args['order_by'].append(desc('_count'))
     try:
-        col = _table.table.c[column]
-        statement = select([col, func.count(col).label('_count')], 
-                group_by=[col], **select_args)
+        statement = select([frequencies.c.value.label(column), 
+                            frequencies.c._count], **select_args)
         log.debug("Distinct: %s" % statement)
         results = _table.bind.execute(statement)
     except OperationalError, oe:
-        raise WebstoreException('Invalid query: %s' % oe.message,
-            format, state='error', code=400)
+        raise _query_failed(oe, format)
     return render_table(request, result_proxy_iterator(results), 
-                        results.keys(), format)
+                        results.keys(), format, 
+                        types=result_proxy_types(results))
 
 @store.route('/<user>/<database>/<table>.<format>', methods=['DELETE'])
 @store.route('/<user>/<database>/<table>', methods=['DELETE'])